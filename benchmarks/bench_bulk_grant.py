@@ -0,0 +1,63 @@
+"""Benchmark a batched coin grant against one load/save per recipient.
+
+Usage: python benchmarks/bench_bulk_grant.py [recipients]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+RECIPIENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+EXISTING_USERS = 20_000
+NAIVE_SAMPLE = 50
+
+
+def seed():
+    data = {'users': {}, 'vending_machines': {}, 'transactions': [], 'tickets': {}}
+    for i in range(EXISTING_USERS):
+        data['users'][str(i)] = {'coins': i % 500, 'authenticated': True, 'join_date': '2026-01-01T00:00:00'}
+    main.save_data(data)
+
+
+def batched(user_ids):
+    data = main.load_data()
+    granted = main.apply_coin_grants(data, user_ids, 10, 'guild')
+    main.save_data(data)
+    for user_id, user in granted.items():
+        main.leaderboard.update(user_id, user)
+
+
+def naive(user_ids):
+    # What /addcoins does today, once per recipient
+    for user_id in user_ids:
+        data = main.load_data()
+        main.apply_coin_grants(data, [user_id], 10, 'guild')
+        main.save_data(data)
+
+
+def run():
+    user_ids = [str(i) for i in range(EXISTING_USERS - RECIPIENTS // 2, EXISTING_USERS + RECIPIENTS // 2)]
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        seed()
+        main.leaderboard.rebuild(main.load_data())
+
+        start = time.perf_counter()
+        batched(user_ids)
+        batched_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        naive(user_ids[:NAIVE_SAMPLE])
+        naive_seconds = (time.perf_counter() - start) / NAIVE_SAMPLE * len(user_ids)
+
+    print(f'recipients:          {len(user_ids)}')
+    print(f'batched grant:       {batched_seconds:.3f}s')
+    print(f'per-recipient (est): {naive_seconds:.3f}s (from {NAIVE_SAMPLE} samples)')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,69 @@
+"""Measure the memory used by cached guild members and what eviction frees.
+
+Usage: python benchmarks/bench_member_cache.py [members]
+"""
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord  # noqa: E402
+
+import main  # noqa: E402
+
+MEMBERS = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+
+
+def guild_payload(members):
+    return {
+        'id': '1',
+        'name': 'bench',
+        'member_count': members,
+        'roles': [{'id': '1', 'name': '@everyone', 'permissions': '0', 'position': 0, 'color': 0,
+                   'hoist': False, 'managed': False, 'mentionable': False}],
+        'members': [
+            {
+                'user': {'id': str(10**17 + i), 'username': f'user{i}', 'discriminator': '0',
+                         'global_name': f'User {i}', 'avatar': None},
+                'roles': ['1'],
+                'joined_at': '2024-01-01T00:00:00+00:00',
+                'deaf': False,
+                'mute': False,
+                'flags': 0
+            }
+            for i in range(members)
+        ]
+    }
+
+
+def allocated():
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def run():
+    intents = discord.Intents.default()
+    intents.members = True
+    client = discord.Client(intents=intents, member_cache_flags=main.build_member_cache_flags(intents))
+
+    payload = guild_payload(MEMBERS)
+    tracemalloc.start()
+    baseline = allocated()
+
+    guild = discord.Guild(data=payload, state=client._connection)
+    del payload
+    cached = allocated()
+
+    main.evict_member_cache(guild)
+    evicted = allocated()
+
+    mib = 1024 * 1024
+    print(f'members:        {MEMBERS}')
+    print(f'member cache:   {(cached - baseline) / mib:.2f} MiB ({(cached - baseline) / MEMBERS:.0f} B/member)')
+    print(f'after eviction: {(evicted - baseline) / mib:.2f} MiB')
+
+
+if __name__ == '__main__':
+    run()
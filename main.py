@@ -1,12 +1,122 @@
 
+import asyncio
+import atexit
+import contextvars
+import copy
+import csv
+import difflib
 import discord
-from discord.ext import commands
+from discord import app_commands
+from discord.ext import commands, tasks
+import gzip
+import io
+import itertools
 import json
+import logging
+import logging.handlers
 import os
-from datetime import datetime
-from flask import Flask
+import queue
+import random
+import shutil
+import signal
+import sys
+import threading
+import traceback
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from flask import Flask, Response, request
 from threading import Thread
+import tempfile
 import time
+from typing import Literal
+from sortedcontainers import SortedList
+
+logger = logging.getLogger('nicorun')
+purchase_logger = logging.getLogger('nicorun.purchase')
+
+# Logging
+# Records are handed to a bounded queue and formatted as JSON lines by a
+# listener thread, so handlers never format or write logs themselves. When the
+# queue is full records are dropped and counted rather than blocking.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_SAMPLE_RATE_PURCHASE = float(os.getenv('LOG_SAMPLE_RATE_PURCHASE', '0.1'))
+
+correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+STANDARD_LOG_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_LOG_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class CorrelationFilter(logging.Filter):
+    """Stamps records with the current interaction's correlation id"""
+
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of INFO and lower records; warnings and errors always pass"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.addFilter(CorrelationFilter())
+
+    def prepare(self, record):
+        # The queue stays in-process, so formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+log_handler = NonBlockingQueueHandler(log_queue)
+log_listener = None
+
+def setup_logging():
+    global log_listener
+    if log_listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers = [log_handler]
+    purchase_logger.addFilter(SamplingFilter(LOG_SAMPLE_RATE_PURCHASE))
+
+def bind_interaction(interaction):
+    correlation_id.set(f'{interaction.id:x}')
 
 # Flask app for Render health check
 app = Flask(__name__)
@@ -19,22 +129,177 @@ def home():
 def health():
     return {"status": "healthy", "bot": "running"}
 
+@app.route('/metrics')
+def metrics():
+    return {
+        "purchase_dedup": purchase_dedup.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "event_loop": loop_watchdog.stats(),
+        "logging": {"dropped": log_handler.dropped},
+        "jobs": job_scheduler.stats()
+    }
+
+@app.route('/debug/profile')
+def debug_profile_endpoint():
+    # Disabled unless DEBUG_TOKEN is set
+    if not DEBUG_TOKEN or request.headers.get('Authorization') != f'Bearer {DEBUG_TOKEN}':
+        return {"error": "not found"}, 404
+
+    seconds = min(request.args.get('seconds', 10, type=int), PROFILE_MAX_SECONDS)
+    stacks = run_profile(seconds)
+    if stacks is None:
+        return {"error": "a profile is already running"}, 409
+    return Response(stacks, mimetype='text/plain',
+                    headers={'Content-Disposition': 'attachment; filename=profile.collapsed.txt'})
+
 def run_flask():
     """Run Flask server"""
     app.run(host='0.0.0.0', port=5000)
 
 # Bot setup
-intents = discord.Intents.default()
-bot = commands.Bot(command_prefix='/', intents=intents)
+# Member caching policy. The members intent is privileged and must also be
+# enabled in the developer portal. Guilds are never chunked at startup; they
+# are chunked the first time a command needs their member list, and the member
+# caches of idle guilds are dropped again (see evict_idle_member_caches).
+ENABLE_MEMBERS_INTENT = os.getenv('ENABLE_MEMBERS_INTENT', '0') == '1'
+MEMBER_CACHE_PROFILE = os.getenv('MEMBER_CACHE_PROFILE', 'minimal')  # full, minimal or none
+MEMBER_CACHE_MAX_GUILDS = int(os.getenv('MEMBER_CACHE_MAX_GUILDS', '50'))
+MEMBER_CACHE_IDLE_SECONDS = int(os.getenv('MEMBER_CACHE_IDLE_SECONDS', '3600'))
+
+def build_intents():
+    intents = discord.Intents.default()
+    intents.members = ENABLE_MEMBERS_INTENT
+    return intents
+
+def build_member_cache_flags(intents):
+    if MEMBER_CACHE_PROFILE == 'none':
+        return discord.MemberCacheFlags.none()
+    flags = discord.MemberCacheFlags.from_intents(intents)
+    if MEMBER_CACHE_PROFILE == 'minimal':
+        # Voice state caching is not used by any command
+        flags.voice = False
+    return flags
+
+# Shutdown state. Every interaction handler task is tracked while it runs so
+# that shutdown() can wait for them to finish.
+SHUTDOWN_DEADLINE = float(os.getenv('SHUTDOWN_DEADLINE', '25'))  # seconds
+shutting_down = False
+inflight_tasks = set()
+
+async def admit_interaction(interaction):
+    """Bind the correlation id and track the handler; refuse new work while shutting down"""
+    bind_interaction(interaction)
+    if shutting_down:
+        if interaction.type is not discord.InteractionType.autocomplete:
+            await interaction.response.send_message('⏳ ボットは再起動中です。しばらくしてからもう一度お試しください。', ephemeral=True)
+        return False
+
+    task = asyncio.current_task()
+    if task is not None and task not in inflight_tasks:
+        inflight_tasks.add(task)
+        task.add_done_callback(inflight_tasks.discard)
+    return True
+
+class InteractionTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction):
+        if not await admit_interaction(interaction):
+            return False
+        if interaction.type is discord.InteractionType.application_command:
+            logger.info('Command invoked', extra={
+                'command': interaction.command.qualified_name if interaction.command else None,
+                'user_id': str(interaction.user.id),
+                'guild_id': str(interaction.guild_id) if interaction.guild_id else None
+            })
+        return True
+
+class BaseView(discord.ui.View):
+    """View that admits interactions through admit_interaction before any callback runs"""
+
+    async def interaction_check(self, interaction):
+        return await admit_interaction(interaction)
+
+class BaseModal(discord.ui.Modal):
+    async def interaction_check(self, interaction):
+        return await admit_interaction(interaction)
+
+intents = build_intents()
+bot = commands.Bot(
+    command_prefix='/',
+    intents=intents,
+    tree_cls=InteractionTree,
+    member_cache_flags=build_member_cache_flags(intents),
+    chunk_guilds_at_startup=False
+)
+
+# Guild id -> time a command last needed the guild's member list, oldest first
+member_cache_activity = OrderedDict()
+
+def touch_member_cache(guild):
+    member_cache_activity.pop(guild.id, None)
+    member_cache_activity[guild.id] = time.monotonic()
+
+async def ensure_member_cache(guild):
+    """Chunk a guild the first time a command needs its full member list, and return the members.
+
+    Requires the members intent. With MEMBER_CACHE_PROFILE=none the members
+    are fetched for the caller but not cached.
+    """
+    touch_member_cache(guild)
+    if guild.chunked:
+        return guild.members
+    # cache=None follows the configured member cache flags
+    members = await guild.chunk(cache=None)
+    if guild.chunked:
+        membership_index.add_guild(guild)
+    return members
+
+def member_cache_ready(guild):
+    """Return True if the member list is complete, otherwise start chunking in the background"""
+    touch_member_cache(guild)
+    if guild.chunked:
+        return True
+    if bot.intents.members and MEMBER_CACHE_PROFILE != 'none':
+        asyncio.create_task(ensure_member_cache(guild))
+    return False
+
+def evict_member_cache(guild):
+    # discord.py has no public API for dropping cached members
+    me_id = bot.user.id if bot.user else None
+    for member in list(guild.members):
+        if member.id != me_id:
+            guild._remove_member(member)
+    membership_index.forget_members(guild.id)
+
+@tasks.loop(minutes=5)
+async def evict_idle_member_caches():
+    now = time.monotonic()
+    while member_cache_activity:
+        guild_id, last_used = next(iter(member_cache_activity.items()))
+        if len(member_cache_activity) <= MEMBER_CACHE_MAX_GUILDS and now - last_used < MEMBER_CACHE_IDLE_SECONDS:
+            break
+        del member_cache_activity[guild_id]
+        guild = bot.get_guild(guild_id)
+        if guild is not None:
+            evict_member_cache(guild)
 
 # Data storage files
 DATA_FILE = 'bot_data.json'
+# The previous version of DATA_FILE, kept as the recovery snapshot
+DATA_SNAPSHOT_FILE = DATA_FILE + '.bak'
+# Version of the data file layout; see maintenance.py, which validates and
+# migrates files offline. Files written before it existed are version 0.
+SCHEMA_VERSION = 1
 
 def load_data():
     if os.path.exists(DATA_FILE):
         with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+            data = json.load(f)
+        if 'schema_version' not in data:
+            # Kept first so maintenance.py can read it without scanning the file
+            data = {'schema_version': SCHEMA_VERSION, **data}
+        return data
     return {
+        'schema_version': SCHEMA_VERSION,
         'users': {},
         'vending_machines': {},
         'transactions': [],
@@ -42,20 +307,614 @@ def load_data():
     }
 
 def save_data(data):
-    with open(DATA_FILE, 'w', encoding='utf-8') as f:
+    # Write a complete new file before swapping it in, so a crash can never leave
+    # DATA_FILE truncated; the replaced version becomes the snapshot
+    tmp_path = DATA_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(DATA_FILE):
+        snapshot_file(DATA_FILE, DATA_SNAPSHOT_FILE)
+    # DATA_FILE is swapped in one step, so it always exists
+    os.replace(tmp_path, DATA_FILE)
+
+def snapshot_file(path, snapshot_path):
+    """Replace snapshot_path with the current contents of path, leaving path in place"""
+    tmp_path = snapshot_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(path, tmp_path)
+    except OSError:
+        # Filesystems without hard links
+        shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, snapshot_path)
+
+def read_data_file(path):
+    """Load and sanity-check a data file, raising ValueError if it is unusable"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError('top level is not an object')
+    for key, expected in (('users', dict), ('vending_machines', dict), ('transactions', list), ('tickets', dict)):
+        if not isinstance(data.get(key), expected):
+            raise ValueError(f'"{key}" is missing or not a {expected.__name__}')
+    return data
+
+def recover_data_file():
+    """Restore DATA_FILE from the snapshot if it is missing, truncated or corrupt.
+
+    Returns a report dict when a recovery was attempted, otherwise None.
+    """
+    start = time.monotonic()
+    if not os.path.exists(DATA_FILE) and not os.path.exists(DATA_SNAPSHOT_FILE):
+        return None
+
+    try:
+        read_data_file(DATA_FILE)
+        return None
+    except FileNotFoundError:
+        reason = 'missing'
+    except (ValueError, UnicodeDecodeError) as e:
+        reason = str(e)
+
+    report = {'reason': reason, 'restored_from': None, 'corrupt_copy': None}
+    if os.path.exists(DATA_FILE):
+        report['corrupt_copy'] = f'{DATA_FILE}.corrupt-{datetime.now().strftime("%Y%m%d%H%M%S")}'
+        os.replace(DATA_FILE, report['corrupt_copy'])
+
+    try:
+        data = read_data_file(DATA_SNAPSHOT_FILE)
+    except (OSError, ValueError, UnicodeDecodeError) as e:
+        report['snapshot_error'] = str(e)
+        logger.error('Data file is unusable and no valid snapshot exists; starting empty', extra=report)
+        return report
+
+    shutil.copyfile(DATA_SNAPSHOT_FILE, DATA_FILE)
+    report.update({
+        'restored_from': DATA_SNAPSHOT_FILE,
+        'users': len(data['users']),
+        'transactions': len(data['transactions']),
+        'tickets': len(data['tickets']),
+        'duration_ms': round((time.monotonic() - start) * 1000, 1)
+    })
+    logger.warning('Recovered data file from snapshot', extra=report)
+    return report
+
+def track_user_guild(user, guild_id):
+    """Remember that a user has interacted with the bot in a guild"""
+    guilds = user.setdefault('guilds', [])
+    if guild_id not in guilds:
+        guilds.append(guild_id)
+
+def backfill_user_guilds(data):
+    """Fill in 'guilds' for users recorded before it existed, from their transactions and tickets.
+
+    Returns True if any user changed. Transactions already moved to the archive
+    are not read, so those users join a server ranking on their next interaction.
+    """
+    changed = False
+    activity = itertools.chain(data['transactions'], data['tickets'].values())
+    for record in activity:
+        user = data['users'].get(record.get('user_id'))
+        guild_id = record.get('guild_id')
+        if user is not None and guild_id and guild_id not in user.get('guilds', ()):
+            track_user_guild(user, guild_id)
+            changed = True
+    return changed
+
+def register_user(data, user_id, guild_id=None):
+    """Add the user to the database (first-time bonus) or mark them authenticated"""
+    if user_id not in data['users']:
+        data['users'][user_id] = {
+            'coins': 100,
+            'authenticated': True,
+            'join_date': datetime.now().isoformat()
+        }
+    else:
+        data['users'][user_id]['authenticated'] = True
+
+    user = data['users'][user_id]
+    if guild_id is not None:
+        track_user_guild(user, guild_id)
+    return user
+
+# Coin leaderboard index
+class CoinLeaderboard:
+    """Coin rankings kept sorted as balances change.
+
+    Entries are ``(-coins, user_id)`` so the richest user sorts first and ties
+    are broken by user id. The index is built from the data file once and then
+    updated in O(log n) by every code path that changes a balance.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.balances = {}
+        self.user_guilds = {}
+        self.global_ranking = SortedList()
+        self.guild_rankings = {}
+
+    def rebuild(self, data):
+        self.balances = {}
+        self.user_guilds = {}
+        self.global_ranking = SortedList()
+        self.guild_rankings = {}
+        self.loaded = True
+        for user_id, user in data['users'].items():
+            self.update(user_id, user)
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.rebuild(load_data())
+
+    def update(self, user_id, user):
+        # Until the first query builds the index there is nothing to maintain
+        if not self.loaded:
+            return
+
+        self.remove(user_id)
+        coins = user.get('coins', 0)
+        guild_ids = set(user.get('guilds', []))
+        entry = (-coins, user_id)
+
+        self.balances[user_id] = coins
+        self.user_guilds[user_id] = guild_ids
+        self.global_ranking.add(entry)
+        for guild_id in guild_ids:
+            self.guild_rankings.setdefault(guild_id, SortedList()).add(entry)
+
+    def remove(self, user_id):
+        if user_id not in self.balances:
+            return
+
+        entry = (-self.balances.pop(user_id), user_id)
+        self.global_ranking.discard(entry)
+        for guild_id in self.user_guilds.pop(user_id, ()):
+            ranking = self.guild_rankings.get(guild_id)
+            if ranking is not None:
+                ranking.discard(entry)
+                if not ranking:
+                    del self.guild_rankings[guild_id]
+
+    def ranking(self, guild_id=None):
+        if guild_id is None:
+            return self.global_ranking
+        return self.guild_rankings.get(guild_id, SortedList())
+
+    def top(self, limit=10, guild_id=None):
+        """Return ``[(user_id, coins), ...]`` for the top ``limit`` users"""
+        self.ensure_loaded()
+        return [(user_id, -neg_coins) for neg_coins, user_id in self.ranking(guild_id)[:limit]]
+
+    def rank(self, user_id, guild_id=None):
+        """Return the 1-based rank of a user, or None if they are not ranked"""
+        self.ensure_loaded()
+        if user_id not in self.balances:
+            return None
+        if guild_id is not None and guild_id not in self.user_guilds[user_id]:
+            return None
+        return self.ranking(guild_id).index((-self.balances[user_id], user_id)) + 1
+
+    def size(self, guild_id=None):
+        self.ensure_loaded()
+        return len(self.ranking(guild_id))
+
+leaderboard = CoinLeaderboard()
+
+# Autocomplete indexes
+class PrefixIndex:
+    """Sorted ``(casefolded key, value)`` pairs answering prefix queries in O(log n)"""
+
+    def __init__(self):
+        self.entries = SortedList()
+
+    def add(self, key, value):
+        self.entries.add((key.casefold(), value))
+
+    def remove(self, key, value):
+        self.entries.discard((key.casefold(), value))
+
+    def search(self, prefix, limit=25):
+        prefix = prefix.casefold()
+        matches = []
+        for _, value in self.entries.irange((prefix,), (prefix + '\U0010ffff',)):
+            if value not in matches:
+                matches.append(value)
+                if len(matches) >= limit:
+                    break
+        return matches
+
+class ItemIndex:
+    """Item names and ids of one guild's vending machine, kept in sync with mutations"""
+
+    def __init__(self, items):
+        self.index = PrefixIndex()
+        self.items = {}
+        for item_id, item in items.items():
+            self.update(item_id, item)
+
+    def update(self, item_id, item):
+        self.remove(item_id)
+        self.items[item_id] = (item['name'], item['price'], item['stock'])
+        self.index.add(item['name'], item_id)
+        self.index.add(item_id, item_id)
+
+    def remove(self, item_id):
+        if item_id in self.items:
+            name = self.items.pop(item_id)[0]
+            self.index.remove(name, item_id)
+            self.index.remove(item_id, item_id)
+
+    def search(self, prefix, limit=25):
+        results = []
+        for item_id in self.index.search(prefix, limit):
+            name, price, stock = self.items[item_id]
+            label = f'{name} ({price}コイン / 在庫{stock}) - ID: {item_id}'
+            results.append((label[:100], item_id))
+        return results
+
+item_indexes = {}
+role_indexes = {}
+
+def get_item_index(guild_id):
+    # Built from storage once per guild, then maintained by index_item()
+    if guild_id not in item_indexes:
+        data = load_data()
+        items = data['vending_machines'].get(guild_id, {}).get('items', {})
+        item_indexes[guild_id] = ItemIndex(items)
+    return item_indexes[guild_id]
+
+def index_item(guild_id, item_id, item):
+    """Reflect a created, changed or deleted (item=None) item in the autocomplete index"""
+    index = item_indexes.get(guild_id)
+    if index is None:
+        return
+    if item is None:
+        index.remove(item_id)
+    else:
+        index.update(item_id, item)
+
+def is_assignable_role(role, guild):
+    return (role.name != '@everyone' and
+            not role.managed and
+            not role.permissions.administrator and
+            role < guild.me.top_role)
+
+def get_role_index(guild):
+    # Rebuilt lazily after role events invalidate it
+    if guild.id not in role_indexes:
+        index = PrefixIndex()
+        for role in guild.roles:
+            if is_assignable_role(role, guild):
+                index.add(role.name, role.name)
+        role_indexes[guild.id] = index
+    return role_indexes[guild.id]
+
+# Transaction archive
+# Old transactions are moved out of DATA_FILE into compressed partitions, one per
+# TRANSACTION_PARTITION_FORMAT period (monthly by default). The format must start
+# with the year so that partition keys sort chronologically.
+TRANSACTION_ARCHIVE_DIR = os.getenv('TRANSACTION_ARCHIVE_DIR', 'transaction_archive')
+TRANSACTION_PARTITION_FORMAT = os.getenv('TRANSACTION_PARTITION_FORMAT', '%Y-%m')
+TRANSACTION_ARCHIVE_MAX_BYTES = int(os.getenv('TRANSACTION_ARCHIVE_MAX_BYTES', str(100 * 1024 * 1024)))
+ARCHIVE_MANIFEST_FILE = os.path.join(TRANSACTION_ARCHIVE_DIR, 'manifest.json')
+
+def partition_key(timestamp):
+    return datetime.fromisoformat(timestamp).strftime(TRANSACTION_PARTITION_FORMAT)
+
+def partition_path(key):
+    return os.path.join(TRANSACTION_ARCHIVE_DIR, f'transactions-{key}.jsonl.gz')
+
+# The manifest is read from disk once and then served from memory. Rotation
+# builds a new manifest in a worker thread and swaps it in when it is saved.
+archive_manifest = None
+
+def load_archive_manifest():
+    global archive_manifest
+    if archive_manifest is None:
+        if os.path.exists(ARCHIVE_MANIFEST_FILE):
+            with open(ARCHIVE_MANIFEST_FILE, 'r', encoding='utf-8') as f:
+                archive_manifest = json.load(f)
+        else:
+            archive_manifest = {'partitions': {}}
+    return archive_manifest
+
+def save_archive_manifest(manifest):
+    global archive_manifest
+    tmp_path = ARCHIVE_MANIFEST_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, ARCHIVE_MANIFEST_FILE)
+    archive_manifest = manifest
+
+def stream_partition(key):
+    """Yield the transactions of a closed partition without loading it whole"""
+    path = partition_path(key)
+    if not os.path.exists(path):
+        return
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def transaction_key(transaction):
+    return (transaction['timestamp'], transaction['user_id'], transaction.get('guild_id'))
+
+def archive_partition(manifest, key, rows):
+    """Append rows to a closed partition and refresh its manifest entry"""
+    os.makedirs(TRANSACTION_ARCHIVE_DIR, exist_ok=True)
+    path = partition_path(key)
+    tmp_path = path + '.tmp'
+
+    entry = {'rows': 0, 'bytes': 0, 'first': None, 'last': None, 'users': {}}
+
+    def write(f, transaction):
+        f.write(json.dumps(transaction, ensure_ascii=False) + '\n')
+        entry['rows'] += 1
+        if entry['first'] is None or transaction['timestamp'] < entry['first']:
+            entry['first'] = transaction['timestamp']
+        if entry['last'] is None or transaction['timestamp'] > entry['last']:
+            entry['last'] = transaction['timestamp']
+        user_id = transaction['user_id']
+        entry['users'][user_id] = entry['users'].get(user_id, 0) + 1
+
+    # Rows may arrive late for a partition that is already archived, or be in it
+    # already if the process died before they were removed from DATA_FILE
+    seen = set()
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        for transaction in stream_partition(key):
+            seen.add(transaction_key(transaction))
+            write(f, transaction)
+        for transaction in rows:
+            if transaction_key(transaction) not in seen:
+                seen.add(transaction_key(transaction))
+                write(f, transaction)
+    os.replace(tmp_path, path)
+
+    entry['bytes'] = os.path.getsize(path)
+    manifest['partitions'][key] = entry
+
+def enforce_archive_retention(manifest):
+    """Drop the oldest partitions until the archive fits TRANSACTION_ARCHIVE_MAX_BYTES"""
+    if TRANSACTION_ARCHIVE_MAX_BYTES <= 0:
+        return []
+
+    dropped = []
+    total = sum(entry['bytes'] for entry in manifest['partitions'].values())
+    for key in sorted(manifest['partitions']):
+        if total <= TRANSACTION_ARCHIVE_MAX_BYTES:
+            break
+        total -= manifest['partitions'].pop(key)['bytes']
+        if os.path.exists(partition_path(key)):
+            os.remove(partition_path(key))
+        dropped.append(key)
+    return dropped
+
+def closed_transactions(data):
+    """Return {partition key: rows} for transactions from periods that have ended"""
+    current_key = datetime.now().strftime(TRANSACTION_PARTITION_FORMAT)
+    closed = {}
+    for transaction in data['transactions']:
+        key = partition_key(transaction['timestamp'])
+        # Transactions are appended in order, so the first open one ends the scan
+        if key >= current_key:
+            break
+        closed.setdefault(key, []).append(transaction)
+    return closed
+
+def archive_transactions(closed):
+    """Write closed rows to their partitions; runs in a worker thread"""
+    manifest = copy.deepcopy(load_archive_manifest())
+    for key, rows in sorted(closed.items()):
+        archive_partition(manifest, key, rows)
+    enforce_archive_retention(manifest)
+    save_archive_manifest(manifest)
+
+async def rotate_transactions():
+    """Move transactions from closed periods out of DATA_FILE into the archive.
+
+    Partitions are rewritten in a worker thread, then the archived rows are
+    removed from DATA_FILE in a single load/save. Purchases made meanwhile are
+    kept, and rows left behind by a crash are skipped when rotated again.
+    """
+    closed = closed_transactions(load_data())
+    if not closed:
+        return 0
+
+    await asyncio.to_thread(archive_transactions, closed)
+
+    archived = {transaction_key(transaction) for rows in closed.values() for transaction in rows}
+    data = load_data()
+    data['transactions'] = [t for t in data['transactions'] if transaction_key(t) not in archived]
+    save_data(data)
+    logger.info('Rotated transactions', extra={'partitions': sorted(closed), 'rows': len(archived)})
+    return len(archived)
+
+@tasks.loop(hours=1)
+async def rotate_transactions_loop():
+    try:
+        await rotate_transactions()
+    except Exception:
+        logger.exception('Failed to rotate transactions')
+
+def record_transaction(data, transaction):
+    data['transactions'].append(transaction)
+
+def iter_transactions(data, since=None, until=None):
+    """Yield transactions oldest first, reading only partitions that overlap [since, until)"""
+    since = since.isoformat() if since else None
+    until = until.isoformat() if until else None
+
+    def in_range(timestamp):
+        return (since is None or timestamp >= since) and (until is None or timestamp < until)
+
+    manifest = load_archive_manifest()
+    for key, entry in sorted(manifest['partitions'].items()):
+        if (since and entry['last'] < since) or (until and entry['first'] >= until):
+            continue
+        for transaction in stream_partition(key):
+            if in_range(transaction['timestamp']):
+                yield transaction
+
+    for transaction in data['transactions']:
+        if in_range(transaction['timestamp']):
+            yield transaction
+
+def recent_user_transactions(data, user_id, limit=10):
+    """Return the user's latest transactions (oldest first), reading newer partitions first"""
+    recent = [t for t in data['transactions'] if t['user_id'] == user_id][-limit:]
+
+    manifest = load_archive_manifest()
+    for key, entry in sorted(manifest['partitions'].items(), reverse=True):
+        if len(recent) >= limit:
+            break
+        if user_id not in entry['users']:
+            continue
+        older = [t for t in stream_partition(key) if t['user_id'] == user_id]
+        recent = older[-(limit - len(recent)):] + recent
+
+    return recent
+
+def count_user_transactions(data, user_id):
+    manifest = load_archive_manifest()
+    archived = sum(entry['users'].get(user_id, 0) for entry in manifest['partitions'].values())
+    return archived + sum(1 for t in data['transactions'] if t['user_id'] == user_id)
 
 @bot.event
 async def on_ready():
-    print(f'{bot.user} has connected to Discord!')
+    logger.info('Connected to Discord', extra={'bot_user': str(bot.user), 'guilds': len(bot.guilds)})
+    data = load_data()
+    if backfill_user_guilds(data):
+        save_data(data)
+    rate_limiter.load_guild_limits(data)
+    load_flash_sales(data)
+    job_scheduler.load(data)
+    job_scheduler.start()
+    loop_watchdog.start(asyncio.get_running_loop())
+    for guild in bot.guilds:
+        membership_index.add_guild(guild)
+    if not evict_idle_member_caches.is_running():
+        evict_idle_member_caches.start()
+    # The first iteration runs now, so old history is archived at startup
+    if not rotate_transactions_loop.is_running():
+        rotate_transactions_loop.start()
     try:
         synced = await bot.tree.sync()
-        print(f'Synced {len(synced)} command(s)')
-    except Exception as e:
-        print(f'Failed to sync commands: {e}')
+        logger.info('Synced %d command(s)', len(synced))
+    except Exception:
+        logger.exception('Failed to sync commands')
+
+# Rate limiting
+# Token buckets are checked before any storage access. Limits are
+# (capacity, seconds to refill a full bucket) per command class; a guild's
+# bucket is GUILD_RATE_MULTIPLIER times larger than a single user's.
+RATE_LIMITS = {
+    'purchase': (5, 10),
+    'read': (10, 30),
+    'auth': (3, 30),
+    'ticket': (2, 60)
+}
+GUILD_RATE_MULTIPLIER = 10
+RATE_LIMIT_MAX_BUCKETS = 50000
+
+class TokenBucket:
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+    def __init__(self, capacity, per):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self):
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class RateLimiter:
+    """Per-user and per-guild token buckets for each command class, LRU-bounded"""
+
+    def __init__(self, limits=RATE_LIMITS, maxsize=RATE_LIMIT_MAX_BUCKETS):
+        self.limits = dict(limits)
+        self.guild_limits = {}
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+        self.allowed = {command_class: 0 for command_class in self.limits}
+        self.throttled = {command_class: 0 for command_class in self.limits}
+
+    def limit_for(self, guild_id, command_class):
+        return self.guild_limits.get(guild_id, {}).get(command_class, self.limits[command_class])
+
+    def bucket(self, key, capacity, per):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(capacity, per)
+            while len(self.buckets) > self.maxsize:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+    def check(self, user_id, guild_id, command_class):
+        """Consume a token; returns 0 if allowed, otherwise seconds until retry"""
+        capacity, per = self.limit_for(guild_id, command_class)
+        buckets = [self.bucket(('user', guild_id, user_id, command_class), capacity, per)]
+        if guild_id is not None:
+            buckets.append(self.bucket(('guild', guild_id, None, command_class), capacity * GUILD_RATE_MULTIPLIER, per))
+
+        now = time.monotonic()
+        for bucket in buckets:
+            bucket.refill(now)
+        retry_after = max(bucket.retry_after() for bucket in buckets)
+
+        if retry_after:
+            self.throttled[command_class] += 1
+            return retry_after
+
+        for bucket in buckets:
+            bucket.tokens -= 1
+        self.allowed[command_class] += 1
+        return 0
+
+    def set_guild_limit(self, guild_id, command_class, capacity, per):
+        self.guild_limits.setdefault(guild_id, {})[command_class] = (capacity, per)
+        # Drop the guild's existing buckets so the new limit applies immediately
+        for key in [key for key in self.buckets if key[1] == guild_id and key[3] == command_class]:
+            del self.buckets[key]
+
+    def load_guild_limits(self, data):
+        for guild_id, settings in data.get('guild_settings', {}).items():
+            for command_class, (capacity, per) in settings.get('rate_limits', {}).items():
+                if command_class in self.limits:
+                    self.guild_limits.setdefault(guild_id, {})[command_class] = (capacity, per)
+
+    def stats(self):
+        return {
+            'allowed': dict(self.allowed),
+            'throttled': dict(self.throttled),
+            'buckets': len(self.buckets)
+        }
+
+rate_limiter = RateLimiter()
+
+async def check_rate_limit(interaction, command_class):
+    """Reply politely and return False if the user or guild is over its limit"""
+    guild_id = str(interaction.guild.id) if interaction.guild else None
+    retry_after = rate_limiter.check(str(interaction.user.id), guild_id, command_class)
+    if retry_after:
+        await interaction.response.send_message(
+            f'⏳ リクエストが多すぎます。{int(retry_after) + 1}秒後にもう一度お試しください。',
+            ephemeral=True
+        )
+        return False
+    return True
 
 # Role Selection View
-class RoleSelectionView(discord.ui.View):
+class RoleSelectionView(BaseView):
     def __init__(self, available_roles):
         super().__init__(timeout=300)
         self.available_roles = available_roles
@@ -79,6 +938,9 @@ class RoleSelectionView(discord.ui.View):
         return role_callback
 
     async def assign_role(self, interaction, role):
+        if not await check_rate_limit(interaction, 'auth'):
+            return
+
         try:
             # Check if user already has the role
             if role in interaction.user.roles:
@@ -91,47 +953,36 @@ class RoleSelectionView(discord.ui.View):
             # Update user data
             data = load_data()
             user_id = str(interaction.user.id)
-            
-            if user_id not in data['users']:
-                data['users'][user_id] = {
-                    'coins': 100,
-                    'authenticated': True,
-                    'join_date': datetime.now().isoformat()
-                }
-            else:
-                data['users'][user_id]['authenticated'] = True
-            
+            user = register_user(data, user_id, str(interaction.guild.id))
             save_data(data)
+            leaderboard.update(user_id, user)
 
             await interaction.response.send_message(f'✅ {role.name} ロールが付与されました！', ephemeral=True)
             
         except discord.Forbidden:
             await interaction.response.send_message('❌ ロールを付与する権限がありません。', ephemeral=True)
         except Exception as e:
+            logger.exception('Failed to assign role')
             await interaction.response.send_message(f'❌ ロールの付与に失敗しました: {str(e)}', ephemeral=True)
 
 # Specific Role View for single role assignment
-class SpecificRoleView(discord.ui.View):
+class SpecificRoleView(BaseView):
     def __init__(self, role):
         super().__init__(timeout=None)
         self.role = role
 
     @discord.ui.button(label='🎭 ロールを取得', style=discord.ButtonStyle.primary, emoji='🎭')
     async def get_role_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if not await check_rate_limit(interaction, 'auth'):
+            return
+
         data = load_data()
         user_id = str(interaction.user.id)
 
         # Add user to database if not exists
-        if user_id not in data['users']:
-            data['users'][user_id] = {
-                'coins': 100,
-                'authenticated': True,
-                'join_date': datetime.now().isoformat()
-            }
-        else:
-            data['users'][user_id]['authenticated'] = True
-
+        user = register_user(data, user_id, str(interaction.guild.id))
         save_data(data)
+        leaderboard.update(user_id, user)
 
         try:
             # Check if user already has the role
@@ -146,38 +997,29 @@ class SpecificRoleView(discord.ui.View):
         except discord.Forbidden:
             await interaction.response.send_message('❌ ロールを付与する権限がありません。', ephemeral=True)
         except Exception as e:
+            logger.exception('Failed to assign role')
             await interaction.response.send_message(f'❌ ロールの付与に失敗しました: {str(e)}', ephemeral=True)
 
 # Public Auth View
-class PublicAuthView(discord.ui.View):
+class PublicAuthView(BaseView):
     def __init__(self):
         super().__init__(timeout=None)
 
     @discord.ui.button(label='🎭 認証する', style=discord.ButtonStyle.primary, emoji='🎭')
     async def authenticate_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if not await check_rate_limit(interaction, 'auth'):
+            return
+
         data = load_data()
         user_id = str(interaction.user.id)
 
         # Add user to database if not exists
-        if user_id not in data['users']:
-            data['users'][user_id] = {
-                'coins': 100,
-                'authenticated': True,
-                'join_date': datetime.now().isoformat()
-            }
-        else:
-            data['users'][user_id]['authenticated'] = True
-
+        user = register_user(data, user_id, str(interaction.guild.id))
         save_data(data)
+        leaderboard.update(user_id, user)
 
         # Get assignable roles (exclude @everyone, bot roles, and admin roles)
-        assignable_roles = []
-        for role in interaction.guild.roles:
-            if (role.name != '@everyone' and 
-                not role.managed and 
-                not role.permissions.administrator and
-                role < interaction.guild.me.top_role):
-                assignable_roles.append(role)
+        assignable_roles = [role for role in interaction.guild.roles if is_assignable_role(role, interaction.guild)]
 
         if not assignable_roles:
             await interaction.response.send_message('❌ 付与可能なロールがありません。', ephemeral=True)
@@ -192,8 +1034,9 @@ class PublicAuthView(discord.ui.View):
 
         # Add role information to embed
         role_list = []
+        show_counts = member_cache_ready(interaction.guild)
         for role in assignable_roles[:10]:  # Show max 10 roles in embed
-            role_list.append(f'• {role.name} ({len(role.members)} メンバー)')
+            role_list.append(f'• {role.name} ({len(role.members)} メンバー)' if show_counts else f'• {role.name}')
         
         embed.add_field(
             name='📋 ロール一覧',
@@ -207,25 +1050,77 @@ class PublicAuthView(discord.ui.View):
         view = RoleSelectionView(assignable_roles)
         await interaction.response.send_message(embed=embed, view=view, ephemeral=True)
 
+# Static panels
+# Panel embeds never change, so they are built once and kept as JSON strings.
+# Embed.from_dict holds on to the dict it is given, so each send decodes a
+# fresh copy rather than sharing one embed between messages.
+def freeze_embed(embed):
+    return json.dumps(embed.to_dict(), ensure_ascii=False)
+
+def static_embed(frozen):
+    return discord.Embed.from_dict(json.loads(frozen))
+
+def build_panel_embed(title, description, footer):
+    embed = discord.Embed(title=title, description=description, color=0x00ff99)
+    embed.set_footer(text=footer)
+    return freeze_embed(embed)
+
+AUTH_PANEL_EMBED = build_panel_embed(
+    '🎭 認証システム',
+    '下のボタンをクリックして認証を行い、ロールを取得してください。\n\n'
+    '**認証について:**\n'
+    '• 初回認証時に100コインを獲得できます\n'
+    '• ボットの全機能を利用できるようになります\n'
+    '• 利用可能なロールから選択できます',
+    '認証は無料です'
+)
+
+TICKET_PANEL_EMBED = build_panel_embed(
+    '🎫 サポートチケット',
+    '何かお困りのことがありましたら、下のボタンをクリックしてサポートチケットを作成してください。\n\n'
+    '**チケットについて:**\n'
+    '• 専用のプライベートチャンネルが作成されます\n'
+    '• あなたとサーバーの管理者のみがアクセス可能です\n'
+    '• 問題が解決したらチケットをクローズしてください',
+    '24時間365日サポート対応'
+)
+
+ROLE_PANEL_EMBED = build_panel_embed(
+    '🎭 ロール取得システム',
+    '下のボタンをクリックして認証を行い、ロールを取得してください。\n\n'
+    '**認証について:**\n'
+    '• 初回認証時に100コインを獲得できます\n'
+    '• ボットの全機能を利用できるようになります\n'
+    '• 利用可能なロールから選択できます\n'
+    '• 誰でも自由に使用できます',
+    '認証は無料です | 24時間利用可能'
+)
+
+# The panel views hold no state and never time out, so one instance per class
+# serves every panel message
+static_views = {}
+
+def static_view(view_cls):
+    view = static_views.get(view_cls)
+    if view is None:
+        view = static_views[view_cls] = view_cls()
+    return view
+
 # Authentication command
 @bot.tree.command(name='auth', description='認証ボタンパネルを設置またはロールを直接取得')
 async def auth(interaction: discord.Interaction, role_name: str = None):
     # If specific role name is provided, directly assign it
     if role_name:
+        if not await check_rate_limit(interaction, 'auth'):
+            return
+
         data = load_data()
         user_id = str(interaction.user.id)
 
         # Add user to database if not exists
-        if user_id not in data['users']:
-            data['users'][user_id] = {
-                'coins': 100,
-                'authenticated': True,
-                'join_date': datetime.now().isoformat()
-            }
-        else:
-            data['users'][user_id]['authenticated'] = True
-
+        user = register_user(data, user_id, str(interaction.guild.id))
         save_data(data)
+        leaderboard.update(user_id, user)
 
         try:
             role = discord.utils.get(interaction.guild.roles, name=role_name)
@@ -239,26 +1134,291 @@ async def auth(interaction: discord.Interaction, role_name: str = None):
             else:
                 await interaction.response.send_message(f'❌ "{role_name}" ロールが見つかりません。', ephemeral=True)
         except Exception as e:
+            logger.exception('Failed to assign role')
             await interaction.response.send_message(f'❌ ロールの付与に失敗しました: {str(e)}', ephemeral=True)
         return
 
     # If no role name provided, create auth panel
-    embed = discord.Embed(
-        title='🎭 認証システム',
-        description='下のボタンをクリックして認証を行い、ロールを取得してください。\n\n'
-                   '**認証について:**\n'
-                   '• 初回認証時に100コインを獲得できます\n'
-                   '• ボットの全機能を利用できるようになります\n'
-                   '• 利用可能なロールから選択できます',
-        color=0x00ff99
-    )
-    embed.set_footer(text='認証は無料です')
+    await interaction.response.send_message(embed=static_embed(AUTH_PANEL_EMBED), view=static_view(PublicAuthView))
+
+# Purchases
+PURCHASE_DEDUP_WINDOW = float(os.getenv('PURCHASE_DEDUP_WINDOW', '3'))  # seconds
+PURCHASE_RETRY_TTL = 900  # interaction tokens are valid for 15 minutes
+PURCHASE_DEDUP_MAX_ENTRIES = 10000
+
+class TTLCache:
+    """Bounded mapping whose entries expire ttl seconds after they are set.
+
+    Every entry has the same ttl, so insertion order is expiry order and expired
+    entries can be dropped from the front. When full, the oldest entry is evicted.
+    """
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def purge(self):
+        now = time.monotonic()
+        while self.entries:
+            key, (expires_at, _) = next(iter(self.entries.items()))
+            if expires_at > now:
+                break
+            del self.entries[key]
+
+    def get(self, key):
+        self.purge()
+        entry = self.entries.get(key)
+        return entry[1] if entry else None
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+class PurchaseDeduplicator:
+    """Remembers recent purchase results so double-clicks and retries are not charged twice.
+
+    Results are keyed by interaction id (client retries) and, for successful
+    purchases, by guild/user/item within PURCHASE_DEDUP_WINDOW (double-clicks).
+    """
+
+    def __init__(self, window=PURCHASE_DEDUP_WINDOW, maxsize=PURCHASE_DEDUP_MAX_ENTRIES):
+        self.by_interaction = TTLCache(PURCHASE_RETRY_TTL, maxsize)
+        self.by_purchase = TTLCache(window, maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, interaction_id, guild_id, user_id, item_id):
+        result = self.by_interaction.get(interaction_id) or self.by_purchase.get((guild_id, user_id, item_id))
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def remember(self, interaction_id, guild_id, user_id, item_id, result):
+        self.by_interaction.set(interaction_id, result)
+        if result[0]:
+            self.by_purchase.set((guild_id, user_id, item_id), result)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'cached_interactions': len(self.by_interaction),
+            'cached_purchases': len(self.by_purchase)
+        }
+
+purchase_dedup = PurchaseDeduplicator()
+
+def process_purchase(guild_id, user_id, item_id):
+    """Validate and apply a purchase in one load/save.
+
+    Returns ``(success, message, data)``; data is the saved state on success.
+    """
+    data = load_data()
+
+    # Check if user exists
+    if user_id not in data['users']:
+        return False, '❌ 先に /auth で認証してください。', None
+
+    # Check if item exists
+    if guild_id not in data['vending_machines'] or item_id not in data['vending_machines'][guild_id]['items']:
+        return False, '❌ アイテムが見つかりません。', None
+
+    item = data['vending_machines'][guild_id]['items'][item_id]
+    user = data['users'][user_id]
+
+    # Check stock
+    if item['stock'] <= 0:
+        return False, '❌ 在庫がありません。', None
+
+    # Check coins
+    if user['coins'] < item['price']:
+        return False, f'❌ コインが不足しています。必要: {item["price"]}、所持: {user["coins"]}', None
+
+    # Process purchase
+    user['coins'] -= item['price']
+    item['stock'] -= 1
 
-    view = PublicAuthView()
-    await interaction.response.send_message(embed=embed, view=view)
+    # Record transaction
+    transaction = {
+        'user_id': user_id,
+        'item_name': item['name'],
+        'price': item['price'],
+        'timestamp': datetime.now().isoformat(),
+        'guild_id': guild_id
+    }
+    record_transaction(data, transaction)
+    track_user_guild(user, guild_id)
+
+    save_data(data)
+    leaderboard.update(user_id, user)
+    index_item(guild_id, item_id, item)
+    purchase_logger.info('Purchase completed', extra={
+        'guild_id': guild_id, 'user_id': user_id, 'item_id': item_id, 'price': item['price']
+    })
+
+    return True, f'✅ {item["name"]} を購入しました！残りコイン: {user["coins"]}', data
+
+def cached_purchase(interaction, item_id):
+    """Return the replayed ``purchase_once`` result if this purchase was just handled, else None"""
+    cached = purchase_dedup.lookup(interaction.id, str(interaction.guild.id), str(interaction.user.id), item_id)
+    if cached is None:
+        return None
+    return cached[0], cached[1], None, True
+
+def purchase_once(interaction, item_id):
+    """Run a purchase unless the same one was just handled.
+
+    Returns ``(success, message, data, duplicate)``. Duplicates replay the
+    original result without touching storage.
+    """
+    cached = cached_purchase(interaction, item_id)
+    if cached is not None:
+        return cached
+
+    guild_id = str(interaction.guild.id)
+    user_id = str(interaction.user.id)
+    success, message, data = process_purchase(guild_id, user_id, item_id)
+    purchase_dedup.remember(interaction.id, guild_id, user_id, item_id, (success, message))
+    return success, message, data, False
+
+def vending_machine_embed(vending_machine):
+    embed = discord.Embed(title='🏪 自動販売機', color=0x00ff00)
+
+    if not vending_machine['items']:
+        embed.description = '商品がありません。'
+    else:
+        for item_id, item in vending_machine['items'].items():
+            embed.add_field(
+                name=f"{item['name']} - {item['price']}コイン",
+                value=f"在庫: {item['stock']}個\nID: {item_id}",
+                inline=True
+            )
+    return embed
+
+# Flash sales
+# Purchases of a flash-sale item go through a per-item queue with a single
+# consumer, ordered by interaction id (a Discord snowflake, so creation time).
+# Remaining stock is tracked in memory, so once it reaches zero later requests
+# are rejected without touching storage.
+class FlashSale:
+    def __init__(self, guild_id, item_id, stock):
+        self.guild_id = guild_id
+        self.item_id = item_id
+        self.remaining = stock
+        self.queue = asyncio.PriorityQueue()
+        self.sequence = itertools.count()
+        self.consumer = None
+
+    @property
+    def sold_out(self):
+        return self.remaining <= 0
+
+    def sold_out_result(self, interaction):
+        """Result for a request arriving after the sale sold out.
+
+        A retry of a purchase that won a unit still replays its original result.
+        """
+        return cached_purchase(interaction, self.item_id) or (False, '❌ 在庫がありません。', None, False)
+
+    async def submit(self, interaction):
+        """Queue a purchase and wait for its ``purchase_once`` result"""
+        if self.consumer is None:
+            self.consumer = asyncio.create_task(self.consume())
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((0, interaction.id, next(self.sequence), interaction, future))
+        return await future
+
+    async def consume(self):
+        while True:
+            _, _, _, interaction, future = await self.queue.get()
+            if interaction is None:
+                return
+
+            if self.sold_out:
+                future.set_result(self.sold_out_result(interaction))
+                continue
+
+            # Whatever goes wrong, resolve the caller's future and keep consuming
+            try:
+                bind_interaction(interaction)
+                result = purchase_once(interaction, self.item_id)
+                success, _, data, duplicate = result
+                # Duplicates replay a cached result and carry no data
+                if success and not duplicate:
+                    self.remaining = data['vending_machines'][self.guild_id]['items'][self.item_id]['stock']
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+
+            if not future.done():
+                future.set_result(result)
+
+    def close(self):
+        # Requests already queued are still processed before the consumer exits
+        if self.consumer is not None:
+            self.queue.put_nowait((1, 0, next(self.sequence), None, None))
+
+flash_sales = {}
+
+def load_flash_sales(data):
+    for guild_id, vending_machine in data['vending_machines'].items():
+        for item_id, item in vending_machine['items'].items():
+            if item.get('flash_sale') and (guild_id, item_id) not in flash_sales:
+                flash_sales[(guild_id, item_id)] = FlashSale(guild_id, item_id, item['stock'])
+
+def refresh_flash_sale(guild_id, item_id, item):
+    """Sync a flash sale with an item changed outside the queue (restock, delete)"""
+    sale = flash_sales.get((guild_id, item_id))
+    if sale is None:
+        return
+    if item is None:
+        flash_sales.pop((guild_id, item_id)).close()
+    else:
+        sale.remaining = item['stock']
+
+def get_flash_sale(interaction, item_id):
+    return flash_sales.get((str(interaction.guild.id), item_id))
+
+@bot.tree.command(name='flashsale', description='アイテムのフラッシュセールモードを切り替え')
+async def toggle_flash_sale(interaction: discord.Interaction, item_id: str, enabled: bool):
+    if not interaction.user.guild_permissions.manage_guild:
+        await interaction.response.send_message('❌ サーバー管理権限が必要です。', ephemeral=True)
+        return
+
+    data = load_data()
+    guild_id = str(interaction.guild.id)
+
+    if guild_id not in data['vending_machines'] or item_id not in data['vending_machines'][guild_id]['items']:
+        await interaction.response.send_message('❌ アイテムが見つかりません。', ephemeral=True)
+        return
+
+    item = data['vending_machines'][guild_id]['items'][item_id]
+    if enabled:
+        item['flash_sale'] = True
+    else:
+        item.pop('flash_sale', None)
+    save_data(data)
+
+    if enabled:
+        if (guild_id, item_id) not in flash_sales:
+            flash_sales[(guild_id, item_id)] = FlashSale(guild_id, item_id, item['stock'])
+        await interaction.response.send_message(f'⚡ "{item["name"]}" のフラッシュセールモードを有効にしました。')
+    else:
+        refresh_flash_sale(guild_id, item_id, None)
+        await interaction.response.send_message(f'✅ "{item["name"]}" のフラッシュセールモードを無効にしました。')
 
 # Vending Machine View with buttons
-class VendingMachineView(discord.ui.View):
+class VendingMachineView(BaseView):
     def __init__(self, guild_id):
         super().__init__(timeout=300)
         self.guild_id = guild_id
@@ -284,72 +1444,44 @@ class VendingMachineView(discord.ui.View):
         return buy_callback
 
     async def buy_item(self, interaction, item_id):
-        data = load_data()
-        guild_id = str(interaction.guild.id)
-        user_id = str(interaction.user.id)
-
-        # Check if user exists
-        if user_id not in data['users']:
-            await interaction.response.send_message('❌ 先に /auth で認証してください。', ephemeral=True)
-            return
-
-        # Check if item exists
-        if guild_id not in data['vending_machines'] or item_id not in data['vending_machines'][guild_id]['items']:
-            await interaction.response.send_message('❌ アイテムが見つかりません。', ephemeral=True)
+        if not await check_rate_limit(interaction, 'purchase'):
             return
 
-        item = data['vending_machines'][guild_id]['items'][item_id]
-        user = data['users'][user_id]
-
-        # Check stock
-        if item['stock'] <= 0:
-            await interaction.response.send_message('❌ 在庫がありません。', ephemeral=True)
-            return
+        sale = get_flash_sale(interaction, item_id)
+        if sale is not None:
+            if sale.sold_out:
+                _, message, _, _ = sale.sold_out_result(interaction)
+                await interaction.response.send_message(message, ephemeral=True)
+                return
 
-        # Check coins
-        if user['coins'] < item['price']:
-            await interaction.response.send_message(f'❌ コインが不足しています。必要: {item["price"]}、所持: {user["coins"]}', ephemeral=True)
+            await interaction.response.defer()
+            success, message, data, duplicate = await sale.submit(interaction)
+            if success and not duplicate:
+                await interaction.edit_original_response(embed=vending_machine_embed(data['vending_machines'][self.guild_id]),
+                                                         view=VendingMachineView(self.guild_id))
+            await interaction.followup.send(message, ephemeral=True)
             return
 
-        # Process purchase
-        user['coins'] -= item['price']
-        item['stock'] -= 1
+        success, message, data, duplicate = purchase_once(interaction, item_id)
 
-        # Record transaction
-        transaction = {
-            'user_id': user_id,
-            'item_name': item['name'],
-            'price': item['price'],
-            'timestamp': datetime.now().isoformat(),
-            'guild_id': guild_id
-        }
-        data['transactions'].append(transaction)
-
-        save_data(data)
+        if not success or duplicate:
+            await interaction.response.send_message(message, ephemeral=True)
+            return
 
         # Update the view with new button states
+        guild_id = str(interaction.guild.id)
         new_view = VendingMachineView(guild_id)
-
-        # Create updated embed
-        vending_machine = data['vending_machines'][guild_id]
-        embed = discord.Embed(title='🏪 自動販売機', color=0x00ff00)
-
-        if not vending_machine['items']:
-            embed.description = '商品がありません。'
-        else:
-            for item_id_display, item_display in vending_machine['items'].items():
-                embed.add_field(
-                    name=f"{item_display['name']} - {item_display['price']}コイン",
-                    value=f"在庫: {item_display['stock']}個\nID: {item_id_display}",
-                    inline=True
-                )
+        embed = vending_machine_embed(data['vending_machines'][guild_id])
 
         await interaction.response.edit_message(embed=embed, view=new_view)
-        await interaction.followup.send(f'✅ {item["name"]} を購入しました！残りコイン: {user["coins"]}', ephemeral=True)
+        await interaction.followup.send(message, ephemeral=True)
 
 # Show vending machine
 @bot.tree.command(name='show', description='自動販売機を表示')
 async def show_vending_machine(interaction: discord.Interaction):
+    if not await check_rate_limit(interaction, 'read'):
+        return
+
     data = load_data()
     guild_id = str(interaction.guild.id)
 
@@ -361,22 +1493,18 @@ async def show_vending_machine(interaction: discord.Interaction):
         save_data(data)
 
     vending_machine = data['vending_machines'][guild_id]
+    embed = vending_machine_embed(vending_machine)
 
     if not vending_machine['items']:
-        embed = discord.Embed(title='🏪 自動販売機', description='商品がありません。', color=0x00ff00)
         await interaction.response.send_message(embed=embed)
     else:
-        embed = discord.Embed(title='🏪 自動販売機', color=0x00ff00)
-        for item_id, item in vending_machine['items'].items():
-            embed.add_field(
-                name=f"{item['name']} - {item['price']}コイン",
-                value=f"在庫: {item['stock']}個\nID: {item_id}",
-                inline=True
-            )
-
         view = VendingMachineView(guild_id)
         await interaction.response.send_message(embed=embed, view=view)
 
+def next_numeric_id(entries):
+    # Ids are never reused, so items deleted with /del leave gaps
+    return str(max((int(entry_id) for entry_id in entries if entry_id.isdigit()), default=0) + 1)
+
 # Add new item to vending machine
 @bot.tree.command(name='newitem', description='自動販売機に新しいアイテムを追加')
 async def new_item(interaction: discord.Interaction, name: str, price: int, stock: int = 1):
@@ -386,7 +1514,7 @@ async def new_item(interaction: discord.Interaction, name: str, price: int, stoc
     if guild_id not in data['vending_machines']:
         data['vending_machines'][guild_id] = {'items': {}}
 
-    item_id = str(len(data['vending_machines'][guild_id]['items']) + 1)
+    item_id = next_numeric_id(data['vending_machines'][guild_id]['items'])
     data['vending_machines'][guild_id]['items'][item_id] = {
         'name': name,
         'price': price,
@@ -395,6 +1523,7 @@ async def new_item(interaction: discord.Interaction, name: str, price: int, stoc
     }
 
     save_data(data)
+    index_item(guild_id, item_id, data['vending_machines'][guild_id]['items'][item_id])
     await interaction.response.send_message(f'✅ アイテム "{name}" を追加しました！（ID: {item_id}）')
 
 # Add coins to user
@@ -407,10 +1536,116 @@ async def add_coins(interaction: discord.Interaction, user: discord.Member, amou
         data['users'][user_id] = {'coins': 0, 'authenticated': False}
 
     data['users'][user_id]['coins'] += amount
+    track_user_guild(data['users'][user_id], str(interaction.guild.id))
     save_data(data)
+    leaderboard.update(user_id, data['users'][user_id])
 
     await interaction.response.send_message(f'✅ {user.display_name} に {amount} コインを追加しました！')
 
+# Bulk coin grants
+scheduled_grants = set()
+MEMBERS_INTENT_REQUIRED = ('❌ ロールのメンバーを取得するにはMembers Intentが必要です。'
+                           '`ENABLE_MEMBERS_INTENT=1` を設定し、Developer Portalでも有効にしてください。')
+
+def apply_coin_grants(data, user_ids, amount, guild_id):
+    """Add amount coins to every user in user_ids, in memory; returns the touched users"""
+    granted = {}
+    for user_id in user_ids:
+        if user_id not in data['users']:
+            data['users'][user_id] = {'coins': 0, 'authenticated': False}
+        user = data['users'][user_id]
+        user['coins'] += amount
+        track_user_guild(user, guild_id)
+        granted[user_id] = user
+    return granted
+
+async def grant_coins_to_role(guild, role, amount, report):
+    """Resolve role members and grant coins in a single load/save.
+
+    report is an async callable used to publish progress messages.
+    """
+    if not bot.intents.members:
+        await report(MEMBERS_INTENT_REQUIRED)
+        return 0
+
+    if not guild.chunked:
+        await report(f'⏳ {role.name} のメンバーを取得しています...')
+    members = await ensure_member_cache(guild)
+
+    user_ids = [
+        str(member.id) for member in members
+        if not member.bot and (role.is_default() or member.get_role(role.id))
+    ]
+    if not user_ids:
+        await report(f'❌ {role.name} ロールを持つメンバーがいません。')
+        return 0
+
+    await report(f'⏳ {len(user_ids)} 人にコインを付与しています...')
+
+    # No awaits between load and save, so concurrent handlers cannot interleave
+    data = load_data()
+    granted = apply_coin_grants(data, user_ids, amount, str(guild.id))
+    save_data(data)
+    for user_id, user in granted.items():
+        leaderboard.update(user_id, user)
+
+    await report(f'✅ {role.name} の {len(granted)} 人に {amount} コインを追加しました！')
+    return len(granted)
+
+@bot.tree.command(name='addcoins-role', description='ロールを持つ全員にコインを追加')
+async def add_coins_role(interaction: discord.Interaction, role: discord.Role, amount: int):
+    if not interaction.user.guild_permissions.manage_guild:
+        await interaction.response.send_message('❌ サーバー管理権限が必要です。', ephemeral=True)
+        return
+
+    await interaction.response.send_message(f'⏳ {role.name} へのコイン付与を開始します...')
+
+    async def report(message):
+        await interaction.edit_original_response(content=message)
+
+    try:
+        await grant_coins_to_role(interaction.guild, role, amount, report)
+    except Exception as e:
+        logger.exception('Failed to grant coins to role')
+        await report(f'❌ コインの付与に失敗しました: {str(e)}')
+
+@bot.tree.command(name='addcoins-schedule', description='指定時間後にロールを持つ全員にコインを追加')
+async def schedule_coins_role(interaction: discord.Interaction, role: discord.Role, amount: int,
+                              minutes: app_commands.Range[int, 1, 10080]):
+    if not interaction.user.guild_permissions.manage_guild:
+        await interaction.response.send_message('❌ サーバー管理権限が必要です。', ephemeral=True)
+        return
+
+    if not bot.intents.members:
+        await interaction.response.send_message(MEMBERS_INTENT_REQUIRED, ephemeral=True)
+        return
+
+    guild = interaction.guild
+    channel = interaction.channel
+    run_at = datetime.now() + timedelta(minutes=minutes)
+
+    async def run_grant():
+        await asyncio.sleep(minutes * 60)
+        # The interaction token expires after 15 minutes, so progress goes to a new message
+        message = await channel.send(f'⏳ {role.name} への予約コイン付与を開始します...')
+
+        async def report(content):
+            await message.edit(content=content)
+
+        try:
+            await grant_coins_to_role(guild, role, amount, report)
+        except Exception as e:
+            logger.exception('Scheduled coin grant failed')
+            await report(f'❌ コインの付与に失敗しました: {str(e)}')
+
+    task = asyncio.create_task(run_grant())
+    scheduled_grants.add(task)
+    task.add_done_callback(scheduled_grants.discard)
+
+    await interaction.response.send_message(
+        f'✅ <t:{int(run_at.timestamp())}:F> に {role.name} の全員へ {amount} コインを付与します。'
+    )
+
 # Delete item from vending machine
 @bot.tree.command(name='del', description='自動販売機からアイテムを削除')
 async def delete_item(interaction: discord.Interaction, item_id: str):
@@ -421,6 +1656,8 @@ async def delete_item(interaction: discord.Interaction, item_id: str):
         item_name = data['vending_machines'][guild_id]['items'][item_id]['name']
         del data['vending_machines'][guild_id]['items'][item_id]
         save_data(data)
+        refresh_flash_sale(guild_id, item_id, None)
+        index_item(guild_id, item_id, None)
         await interaction.response.send_message(f'✅ アイテム "{item_name}" を削除しました！')
     else:
         await interaction.response.send_message('❌ アイテムが見つかりません。')
@@ -435,6 +1672,7 @@ async def change_price(interaction: discord.Interaction, item_id: str, new_price
         old_price = data['vending_machines'][guild_id]['items'][item_id]['price']
         data['vending_machines'][guild_id]['items'][item_id]['price'] = new_price
         save_data(data)
+        index_item(guild_id, item_id, data['vending_machines'][guild_id]['items'][item_id])
         await interaction.response.send_message(f'✅ 価格を {old_price} → {new_price} コインに変更しました！')
     else:
         await interaction.response.send_message('❌ アイテムが見つかりません。')
@@ -448,65 +1686,201 @@ async def add_stock(interaction: discord.Interaction, item_id: str, amount: int)
     if guild_id in data['vending_machines'] and item_id in data['vending_machines'][guild_id]['items']:
         data['vending_machines'][guild_id]['items'][item_id]['stock'] += amount
         save_data(data)
+        refresh_flash_sale(guild_id, item_id, data['vending_machines'][guild_id]['items'][item_id])
+        index_item(guild_id, item_id, data['vending_machines'][guild_id]['items'][item_id])
         await interaction.response.send_message(f'✅ 在庫を {amount} 個追加しました！')
     else:
         await interaction.response.send_message('❌ アイテムが見つかりません。')
 
-# Buy item from vending machine
-@bot.tree.command(name='buy', description='自動販売機からアイテムを購入')
-async def buy_item(interaction: discord.Interaction, item_id: str):
-    data = load_data()
-    guild_id = str(interaction.guild.id)
-    user_id = str(interaction.user.id)
+# Bulk import items
+IMPORT_MAX_BYTES = 1024 * 1024
+IMPORT_MAX_ROWS = 1000
 
-    # Check if user exists
-    if user_id not in data['users']:
-        await interaction.response.send_message('❌ 先に /auth で認証してください。')
+def parse_item_rows(filename, content):
+    """Parse an uploaded CSV (name,price,stock) or JSON array of items"""
+    text = content.decode('utf-8-sig')
+    if filename.lower().endswith('.json'):
+        try:
+            rows = json.loads(text)
+        except RecursionError:
+            raise ValueError('JSONの入れ子が深すぎます') from None
+        if not isinstance(rows, list):
+            raise ValueError('JSONはアイテムの配列である必要があります')
+        return rows
+    try:
+        return list(csv.DictReader(io.StringIO(text)))
+    except csv.Error as e:
+        # e.g. a cell longer than csv.field_size_limit()
+        raise ValueError(f'CSVを解析できません: {e}') from None
+
+def parse_whole_number(value):
+    """Return value as an int, rejecting booleans and fractional numbers"""
+    # bool is a subclass of int, and int() would silently truncate 2.9
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(value)
+        return int(value)
+    if isinstance(value, str):
+        return int(value.strip())
+    if isinstance(value, int):
+        return value
+    raise TypeError(value)
+
+def validate_item_row(row):
+    """Return (name, price, stock) for a row, raising ValueError with the reason"""
+    if not isinstance(row, dict):
+        raise ValueError('行の形式が不正です')
+
+    name = str(row.get('name') or '').strip()
+    if not name:
+        raise ValueError('名前がありません')
+    if len(name) > 60:
+        raise ValueError('名前が長すぎます（60文字まで）')
+
+    try:
+        price = parse_whole_number(row.get('price'))
+        stock = parse_whole_number(row.get('stock') if row.get('stock') not in (None, '') else 1)
+    except (TypeError, ValueError):
+        raise ValueError('価格または在庫が数値ではありません')
+    if price < 0 or stock < 0:
+        raise ValueError('価格と在庫は0以上である必要があります')
+
+    return name, price, stock
+
+def apply_item_import(items, rows, user_id, upsert=True):
+    """Validate all rows, then create or update items in place.
+
+    Items are matched by name when upsert is enabled. Returns
+    ``(created, updated, rejected)`` where rejected is ``[(row_number, reason)]``.
+    """
+    valid = []
+    rejected = []
+    seen_names = set()
+    for row_number, row in enumerate(rows, start=1):
+        try:
+            name, price, stock = validate_item_row(row)
+        except ValueError as e:
+            rejected.append((row_number, str(e)))
+            continue
+        if name in seen_names:
+            rejected.append((row_number, f'"{name}" がファイル内で重複しています'))
+            continue
+        seen_names.add(name)
+        valid.append((row_number, name, price, stock))
+
+    item_ids_by_name = {item['name']: item_id for item_id, item in items.items()}
+    created = []
+    updated = []
+    for row_number, name, price, stock in valid:
+        if name in item_ids_by_name:
+            if not upsert:
+                rejected.append((row_number, f'"{name}" は既に存在します'))
+                continue
+            item = items[item_ids_by_name[name]]
+            item['price'] = price
+            item['stock'] = stock
+            updated.append(item_ids_by_name[name])
+        else:
+            item_id = next_numeric_id(items)
+            items[item_id] = {
+                'name': name,
+                'price': price,
+                'stock': stock,
+                'created_by': user_id
+            }
+            item_ids_by_name[name] = item_id
+            created.append(item_id)
+
+    rejected.sort()
+    return created, updated, rejected
+
+@bot.tree.command(name='importitems', description='ファイルから自動販売機のアイテムを一括登録')
+async def import_items(interaction: discord.Interaction, file: discord.Attachment, upsert: bool = True):
+    if not interaction.user.guild_permissions.manage_guild:
+        await interaction.response.send_message('❌ サーバー管理権限が必要です。', ephemeral=True)
         return
 
-    # Check if item exists
-    if guild_id not in data['vending_machines'] or item_id not in data['vending_machines'][guild_id]['items']:
-        await interaction.response.send_message('❌ アイテムが見つかりません。')
+    if not file.filename.lower().endswith(('.csv', '.json')):
+        await interaction.response.send_message('❌ CSVまたはJSONファイルを添付してください。', ephemeral=True)
         return
 
-    item = data['vending_machines'][guild_id]['items'][item_id]
-    user = data['users'][user_id]
+    if file.size > IMPORT_MAX_BYTES:
+        await interaction.response.send_message('❌ ファイルが大きすぎます（1MBまで）。', ephemeral=True)
+        return
 
-    # Check stock
-    if item['stock'] <= 0:
-        await interaction.response.send_message('❌ 在庫がありません。')
+    try:
+        rows = parse_item_rows(file.filename, await file.read())
+    except (ValueError, UnicodeDecodeError) as e:
+        await interaction.response.send_message(f'❌ ファイルを読み込めませんでした: {str(e)}', ephemeral=True)
         return
 
-    # Check coins
-    if user['coins'] < item['price']:
-        await interaction.response.send_message(f'❌ コインが不足しています。必要: {item["price"]}、所持: {user["coins"]}')
+    if len(rows) > IMPORT_MAX_ROWS:
+        await interaction.response.send_message(f'❌ 行数が多すぎます（{IMPORT_MAX_ROWS}行まで）。', ephemeral=True)
         return
 
-    # Process purchase
-    user['coins'] -= item['price']
-    item['stock'] -= 1
+    data = load_data()
+    guild_id = str(interaction.guild.id)
 
-    # Record transaction
-    transaction = {
-        'user_id': user_id,
-        'item_name': item['name'],
-        'price': item['price'],
-        'timestamp': datetime.now().isoformat(),
-        'guild_id': guild_id
-    }
-    data['transactions'].append(transaction)
+    if guild_id not in data['vending_machines']:
+        data['vending_machines'][guild_id] = {'items': {}}
 
-    save_data(data)
+    items = data['vending_machines'][guild_id]['items']
+    created, updated, rejected = apply_item_import(items, rows, str(interaction.user.id), upsert)
+
+    if created or updated:
+        save_data(data)
+        for item_id in updated:
+            refresh_flash_sale(guild_id, item_id, items[item_id])
+        for item_id in created + updated:
+            index_item(guild_id, item_id, items[item_id])
+
+    embed = discord.Embed(title='📦 アイテム一括登録', color=0x00ff00 if not rejected else 0xff9900)
+    embed.add_field(name='✅ 追加', value=f'{len(created)}件', inline=True)
+    embed.add_field(name='🔄 更新', value=f'{len(updated)}件', inline=True)
+    embed.add_field(name='❌ エラー', value=f'{len(rejected)}件', inline=True)
+    if rejected:
+        embed.add_field(
+            name='エラー詳細',
+            value='\n'.join(f'行 {row_number}: {reason}' for row_number, reason in rejected[:10]) +
+                  ('\n...' if len(rejected) > 10 else ''),
+            inline=False
+        )
+
+    await interaction.response.send_message(embed=embed)
+
+# Buy item from vending machine
+@bot.tree.command(name='buy', description='自動販売機からアイテムを購入')
+async def buy_item(interaction: discord.Interaction, item_id: str):
+    if not await check_rate_limit(interaction, 'purchase'):
+        return
+
+    sale = get_flash_sale(interaction, item_id)
+    if sale is not None:
+        if sale.sold_out:
+            _, message, _, _ = sale.sold_out_result(interaction)
+            await interaction.response.send_message(message)
+            return
 
-    await interaction.response.send_message(f'✅ {item["name"]} を購入しました！残りコイン: {user["coins"]}')
+        await interaction.response.defer()
+        _, message, _, _ = await sale.submit(interaction)
+        await interaction.followup.send(message)
+        return
+
+    _, message, _, _ = purchase_once(interaction, item_id)
+    await interaction.response.send_message(message)
 
 # View transactions
 @bot.tree.command(name='transaction', description='取引履歴を表示')
 async def view_transactions(interaction: discord.Interaction):
+    if not await check_rate_limit(interaction, 'read'):
+        return
+
     data = load_data()
     user_id = str(interaction.user.id)
 
-    user_transactions = [t for t in data['transactions'] if t['user_id'] == user_id]
+    user_transactions = recent_user_transactions(data, user_id, 10)
 
     if not user_transactions:
         await interaction.response.send_message('取引履歴がありません。')
@@ -514,7 +1888,7 @@ async def view_transactions(interaction: discord.Interaction):
 
     embed = discord.Embed(title='📊 取引履歴', color=0x0099ff)
 
-    for i, transaction in enumerate(user_transactions[-10:]):  # Show last 10 transactions
+    for i, transaction in enumerate(user_transactions):  # Show last 10 transactions
         embed.add_field(
             name=f"{i+1}. {transaction['item_name']}",
             value=f"価格: {transaction['price']}コイン\n日時: {transaction['timestamp'][:10]}",
@@ -524,11 +1898,24 @@ async def view_transactions(interaction: discord.Interaction):
     await interaction.response.send_message(embed=embed)
 
 # Ticket system
+def next_ticket_id(data):
+    """Issue the next ticket id.
+
+    The last issued id is kept in data['ticket_counter'], because maintenance.py
+    compact can remove the highest-numbered tickets.
+    """
+    ticket_id = max(data.get('ticket_counter', 0), int(next_numeric_id(data['tickets'])) - 1) + 1
+    data['ticket_counter'] = ticket_id
+    return str(ticket_id)
+
 @bot.tree.command(name='ticket', description='サポートチケットを作成')
 async def create_ticket(interaction: discord.Interaction, subject: str, description: str = ""):
+    if not await check_rate_limit(interaction, 'ticket'):
+        return
+
     data = load_data()
     user_id = str(interaction.user.id)
-    ticket_id = str(len(data['tickets']) + 1)
+    ticket_id = next_ticket_id(data)
 
     # Create ticket channel
     guild = interaction.guild
@@ -541,14 +1928,13 @@ async def create_ticket(interaction: discord.Interaction, subject: str, descript
     # Set permissions for the ticket channel
     overwrites = {
         guild.default_role: discord.PermissionOverwrite(read_messages=False),
-        interaction.user: discord.PermissionOverwrite(read_messages=True, send_messages=True),
-        guild.owner: discord.PermissionOverwrite(read_messages=True, send_messages=True)
+        interaction.user: discord.PermissionOverwrite(read_messages=True, send_messages=True)
     }
 
-    # Add permissions for users with Administrator permission
-    for member in guild.members:
-        if member.guild_permissions.administrator:
-            overwrites[member] = discord.PermissionOverwrite(read_messages=True, send_messages=True)
+    # The owner may not be cached. Administrators bypass channel overwrites, so
+    # they need no entry (and the full member list is not needed to find them)
+    if guild.owner is not None:
+        overwrites[guild.owner] = discord.PermissionOverwrite(read_messages=True, send_messages=True)
 
     # Create the ticket channel
     channel_name = f"ticket-{ticket_id}-{interaction.user.name}"
@@ -592,10 +1978,81 @@ async def create_ticket(interaction: discord.Interaction, subject: str, descript
         )
 
     except Exception as e:
+        logger.exception('Failed to create ticket channel')
         await interaction.response.send_message(f'❌ チケットチャンネルの作成に失敗しました: {str(e)}', ephemeral=True)
 
+# Ticket transcripts
+# On close, the channel history is streamed oldest first (discord.py fetches
+# 100 messages per request and waits out rate limits) and written in batches
+# to a gzip-compressed JSONL file, so only one batch is held in memory.
+TRANSCRIPT_DIR = os.getenv('TRANSCRIPT_DIR', 'transcripts')
+TRANSCRIPT_BATCH_SIZE = 100
+DELETE_TICKET_CHANNEL_ON_CLOSE = os.getenv('DELETE_TICKET_CHANNEL_ON_CLOSE', '0') == '1'
+
+def transcript_path(ticket_id):
+    return os.path.join(TRANSCRIPT_DIR, f'ticket-{ticket_id}.jsonl.gz')
+
+def transcript_record(message):
+    return {
+        'id': str(message.id),
+        'created_at': message.created_at.isoformat(),
+        'author_id': str(message.author.id),
+        'author': message.author.display_name,
+        'content': message.content,
+        'attachments': [attachment.url for attachment in message.attachments],
+        'embeds': [embed.to_dict() for embed in message.embeds]
+    }
+
+async def archive_ticket_channel(channel, path):
+    """Write the channel's history to path; returns the number of messages"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    f = await asyncio.to_thread(gzip.open, tmp_path, 'wt', encoding='utf-8')
+
+    count = 0
+    batch = []
+    try:
+        async for message in channel.history(limit=None, oldest_first=True):
+            batch.append(json.dumps(transcript_record(message), ensure_ascii=False) + '\n')
+            count += 1
+            if len(batch) >= TRANSCRIPT_BATCH_SIZE:
+                await asyncio.to_thread(f.write, ''.join(batch))
+                batch = []
+        if batch:
+            await asyncio.to_thread(f.write, ''.join(batch))
+    finally:
+        await asyncio.to_thread(f.close)
+
+    os.replace(tmp_path, path)
+    return count
+
+async def archive_ticket(ticket_id, channel):
+    """Archive a closed ticket's channel, record it on the ticket and optionally delete the channel"""
+    path = transcript_path(ticket_id)
+    count = await archive_ticket_channel(channel, path)
+
+    data = load_data()
+    ticket = data['tickets'].get(ticket_id)
+    if ticket is not None:
+        ticket['transcript'] = {
+            'path': path,
+            'messages': count,
+            'bytes': os.path.getsize(path),
+            'archived_at': datetime.now().isoformat()
+        }
+        save_data(data)
+
+    if DELETE_TICKET_CHANNEL_ON_CLOSE:
+        await channel.delete(reason=f'Ticket #{ticket_id} closed and archived')
+        data = load_data()
+        if ticket_id in data['tickets']:
+            data['tickets'][ticket_id]['channel_deleted'] = True
+            save_data(data)
+
+    return count
+
 # Ticket View with close button
-class TicketView(discord.ui.View):
+class TicketView(BaseView):
     def __init__(self, ticket_id):
         super().__init__(timeout=None)
         self.ticket_id = ticket_id
@@ -638,11 +2095,24 @@ class TicketView(discord.ui.View):
         await interaction.response.edit_message(embed=embed, view=self)
 
         # Send confirmation message
-        await interaction.followup.send('🔒 チケットがクローズされました。')
+        await interaction.followup.send('🔒 チケットがクローズされました。トランスクリプトを保存しています...')
+
+        try:
+            count = await archive_ticket(self.ticket_id, interaction.channel)
+        except Exception:
+            logger.exception('Failed to archive ticket', extra={'ticket_id': self.ticket_id})
+            await interaction.followup.send('❌ トランスクリプトの保存に失敗しました。')
+            return
+
+        if not DELETE_TICKET_CHANNEL_ON_CLOSE:
+            await interaction.followup.send(f'📄 トランスクリプトを保存しました（{count}件）。`/transcript {self.ticket_id}` で取得できます。')
 
 # List tickets command
 @bot.tree.command(name='tickets', description='チケット一覧を表示')
 async def list_tickets(interaction: discord.Interaction):
+    if not await check_rate_limit(interaction, 'read'):
+        return
+
     data = load_data()
     guild_id = str(interaction.guild.id)
 
@@ -667,6 +2137,38 @@ async def list_tickets(interaction: discord.Interaction):
 
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
+# Fetch ticket transcript
+@bot.tree.command(name='transcript', description='クローズしたチケットのトランスクリプトを取得')
+async def get_transcript(interaction: discord.Interaction, ticket_id: str):
+    if not await check_rate_limit(interaction, 'read'):
+        return
+
+    data = load_data()
+    ticket = data['tickets'].get(ticket_id)
+
+    if ticket is None or ticket['guild_id'] != str(interaction.guild.id):
+        await interaction.response.send_message('❌ チケットが見つかりません。', ephemeral=True)
+        return
+
+    if str(interaction.user.id) != ticket['user_id'] and not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message('❌ このチケットのトランスクリプトを見る権限がありません。', ephemeral=True)
+        return
+
+    transcript = ticket.get('transcript')
+    if not transcript or not os.path.exists(transcript['path']):
+        await interaction.response.send_message('❌ このチケットのトランスクリプトはありません。', ephemeral=True)
+        return
+
+    if transcript['bytes'] > interaction.guild.filesize_limit:
+        await interaction.response.send_message('❌ トランスクリプトがファイルサイズの上限を超えています。', ephemeral=True)
+        return
+
+    await interaction.response.send_message(
+        f'📄 チケット #{ticket_id} のトランスクリプト（{transcript["messages"]}件）',
+        file=discord.File(transcript['path'], filename=f'ticket-{ticket_id}-transcript.jsonl.gz'),
+        ephemeral=True
+    )
+
 # Nuke channel
 @bot.tree.command(name='nuke', description='チャンネルを再生成（設定を引き継ぎ）')
 async def nuke_channel(interaction: discord.Interaction):
@@ -707,6 +2209,9 @@ async def view_profile(interaction: discord.Interaction, user: discord.Member =
     if user is None:
         user = interaction.user
 
+    if not await check_rate_limit(interaction, 'read'):
+        return
+
     data = load_data()
     user_id = str(user.id)
 
@@ -715,20 +2220,50 @@ async def view_profile(interaction: discord.Interaction, user: discord.Member =
         return
 
     user_data = data['users'][user_id]
-    user_transactions = [t for t in data['transactions'] if t['user_id'] == user_id]
+    purchase_count = count_user_transactions(data, user_id)
 
     embed = discord.Embed(
         title=f'👤 {user.display_name} のプロフィール',
         color=0x00ff00
     )
     embed.add_field(name='💰 コイン', value=str(user_data['coins']), inline=True)
-    embed.add_field(name='🛒 購入回数', value=str(len(user_transactions)), inline=True)
+    embed.add_field(name='🛒 購入回数', value=str(purchase_count), inline=True)
     embed.add_field(name='✅ 認証状態', value='認証済み' if user_data.get('authenticated') else '未認証', inline=True)
 
     await interaction.response.send_message(embed=embed)
 
+# Coin leaderboard
+@bot.tree.command(name='leaderboard', description='コインランキングを表示')
+async def view_leaderboard(interaction: discord.Interaction, scope: Literal['server', 'global'] = 'server',
+                           limit: app_commands.Range[int, 1, 25] = 10):
+    guild_id = str(interaction.guild.id) if scope == 'server' else None
+    user_id = str(interaction.user.id)
+
+    top_users = leaderboard.top(limit, guild_id)
+    if not top_users:
+        await interaction.response.send_message('ランキングに表示できるユーザーがいません。', ephemeral=True)
+        return
+
+    medals = {1: '🥇', 2: '🥈', 3: '🥉'}
+    lines = [
+        f"{medals.get(position, f'{position}.')} <@{ranked_user_id}> - {coins}コイン"
+        for position, (ranked_user_id, coins) in enumerate(top_users, start=1)
+    ]
+
+    embed = discord.Embed(
+        title='🏆 コインランキング' + ('（サーバー）' if guild_id else '（全体）'),
+        description='\n'.join(lines),
+        color=0xffd700
+    )
+
+    rank = leaderboard.rank(user_id, guild_id)
+    total = leaderboard.size(guild_id)
+    embed.set_footer(text=f'あなたの順位: {rank}位 / {total}人' if rank else f'あなたはランク外です（{total}人）')
+
+    await interaction.response.send_message(embed=embed)
+
 # Public Ticket Creation View
-class PublicTicketView(discord.ui.View):
+class PublicTicketView(BaseView):
     def __init__(self):
         super().__init__(timeout=None)
 
@@ -739,7 +2274,7 @@ class PublicTicketView(discord.ui.View):
         await interaction.response.send_modal(modal)
 
 # Ticket Creation Modal
-class TicketModal(discord.ui.Modal, title='🎫 チケット作成'):
+class TicketModal(BaseModal, title='🎫 チケット作成'):
     def __init__(self):
         super().__init__()
 
@@ -759,9 +2294,12 @@ class TicketModal(discord.ui.Modal, title='🎫 チケット作成'):
     )
 
     async def on_submit(self, interaction: discord.Interaction):
+        if not await check_rate_limit(interaction, 'ticket'):
+            return
+
         data = load_data()
         user_id = str(interaction.user.id)
-        ticket_id = str(len(data['tickets']) + 1)
+        ticket_id = next_ticket_id(data)
 
         # Create ticket channel
         guild = interaction.guild
@@ -774,14 +2312,13 @@ class TicketModal(discord.ui.Modal, title='🎫 チケット作成'):
         # Set permissions for the ticket channel
         overwrites = {
             guild.default_role: discord.PermissionOverwrite(read_messages=False),
-            interaction.user: discord.PermissionOverwrite(read_messages=True, send_messages=True),
-            guild.owner: discord.PermissionOverwrite(read_messages=True, send_messages=True)
+            interaction.user: discord.PermissionOverwrite(read_messages=True, send_messages=True)
         }
 
-        # Add permissions for users with Administrator permission
-        for member in guild.members:
-            if member.guild_permissions.administrator:
-                overwrites[member] = discord.PermissionOverwrite(read_messages=True, send_messages=True)
+        # The owner may not be cached. Administrators bypass channel overwrites, so
+        # they need no entry (and the full member list is not needed to find them)
+        if guild.owner is not None:
+            overwrites[guild.owner] = discord.PermissionOverwrite(read_messages=True, send_messages=True)
 
         # Create the ticket channel
         channel_name = f"ticket-{ticket_id}-{interaction.user.name}"
@@ -825,6 +2362,7 @@ class TicketModal(discord.ui.Modal, title='🎫 チケット作成'):
             )
 
         except Exception as e:
+            logger.exception('Failed to create ticket channel')
             await interaction.response.send_message(f'❌ チケットチャンネルの作成に失敗しました: {str(e)}', ephemeral=True)
 
 # Ticket panel command
@@ -834,19 +2372,7 @@ async def ticket_panel(interaction: discord.Interaction):
         await interaction.response.send_message('❌ チャンネル管理権限が必要です。', ephemeral=True)
         return
 
-    embed = discord.Embed(
-        title='🎫 サポートチケット',
-        description='何かお困りのことがありましたら、下のボタンをクリックしてサポートチケットを作成してください。\n\n'
-                   '**チケットについて:**\n'
-                   '• 専用のプライベートチャンネルが作成されます\n'
-                   '• あなたとサーバーの管理者のみがアクセス可能です\n'
-                   '• 問題が解決したらチケットをクローズしてください',
-        color=0x00ff99
-    )
-    embed.set_footer(text='24時間365日サポート対応')
-
-    view = PublicTicketView()
-    await interaction.response.send_message(embed=embed, view=view)
+    await interaction.response.send_message(embed=static_embed(TICKET_PANEL_EMBED), view=static_view(PublicTicketView))
 
 # Setup role panel command
 @bot.tree.command(name='setuprole', description='ロール取得パネルを設置')
@@ -863,10 +2389,7 @@ async def setup_role(interaction: discord.Interaction, role_name: str = None):
             return
         
         # Check if the role can be assigned
-        if (role.name == '@everyone' or 
-            role.managed or 
-            role.permissions.administrator or
-            role >= interaction.guild.me.top_role):
+        if not is_assignable_role(role, interaction.guild):
             await interaction.response.send_message(f'❌ "{role_name}" ロールは付与できません。', ephemeral=True)
             return
 
@@ -881,7 +2404,7 @@ async def setup_role(interaction: discord.Interaction, role_name: str = None):
         )
         embed.add_field(
             name='📋 取得可能なロール',
-            value=f'• {role_name} ({len(role.members)} メンバー)',
+            value=f'• {role_name} ({len(role.members)} メンバー)' if member_cache_ready(interaction.guild) else f'• {role_name}',
             inline=False
         )
         embed.set_footer(text='認証は無料です | 24時間利用可能')
@@ -890,63 +2413,750 @@ async def setup_role(interaction: discord.Interaction, role_name: str = None):
         await interaction.response.send_message(embed=embed, view=view)
     else:
         # Original behavior - show all available roles
-        embed = discord.Embed(
-            title='🎭 ロール取得システム',
-            description='下のボタンをクリックして認証を行い、ロールを取得してください。\n\n'
-                       '**認証について:**\n'
-                       '• 初回認証時に100コインを獲得できます\n'
-                       '• ボットの全機能を利用できるようになります\n'
-                       '• 利用可能なロールから選択できます\n'
-                       '• 誰でも自由に使用できます',
-            color=0x00ff99
-        )
-        embed.set_footer(text='認証は無料です | 24時間利用可能')
+        await interaction.response.send_message(embed=static_embed(ROLE_PANEL_EMBED), view=static_view(PublicAuthView))
 
-        view = PublicAuthView()
-        await interaction.response.send_message(embed=embed, view=view)
+# Membership index
+class MembershipIndex:
+    """Reverse index of user id -> {guild id: join date} for guilds shared with the bot.
+
+    Maintained from guild and member events, so /servers does not have to walk
+    user.mutual_guilds. A guild is complete once its member list has been
+    chunked; other guilds are checked against the live member cache on every
+    lookup. Entries are dropped with the member cache (see evict_member_cache),
+    so the index never outgrows it. Guild names and member counts are cached alongside.
+    """
+
+    def __init__(self):
+        self.user_guilds = {}
+        self.guild_members = {}
+        self.guild_summaries = {}
+        self.complete_guilds = set()
+
+    def add(self, member):
+        self.user_guilds.setdefault(member.id, {})[member.guild.id] = self.join_date(member)
+        self.guild_members.setdefault(member.guild.id, set()).add(member.id)
+
+    @staticmethod
+    def join_date(member):
+        return member.joined_at.strftime('%Y/%m/%d') if member.joined_at else None
+
+    def remove(self, user_id, guild_id):
+        guilds = self.user_guilds.get(user_id)
+        if guilds is not None:
+            guilds.pop(guild_id, None)
+            if not guilds:
+                del self.user_guilds[user_id]
+        self.guild_members.get(guild_id, set()).discard(user_id)
+
+    def add_guild(self, guild):
+        self.update_summary(guild)
+        for member in guild.members:
+            self.add(member)
+        if guild.chunked:
+            self.complete_guilds.add(guild.id)
+
+    def forget_members(self, guild_id):
+        """Drop a guild's member entries, e.g. when its member cache is evicted"""
+        self.complete_guilds.discard(guild_id)
+        for user_id in self.guild_members.pop(guild_id, set()):
+            self.remove(user_id, guild_id)
+
+    def remove_guild(self, guild_id):
+        self.forget_members(guild_id)
+        self.guild_summaries.pop(guild_id, None)
+
+    def update_summary(self, guild):
+        self.guild_summaries[guild.id] = {'name': guild.name, 'member_count': guild.member_count}
+
+    def guilds_for(self, user):
+        """Return ``[(guild_id, join date)]`` sorted by guild name"""
+        guilds = dict(self.user_guilds.get(user.id, {}))
+
+        # Guilds that are not fully indexed may still have the user in their cache
+        for guild in bot.guilds:
+            if guild.id in self.complete_guilds or guild.id in guilds:
+                continue
+            member = guild.get_member(user.id)
+            if member is not None:
+                self.update_summary(guild)
+                guilds[guild.id] = self.join_date(member)
+
+        return sorted(guilds.items(), key=lambda entry: self.guild_summaries.get(entry[0], {}).get('name', ''))
+
+membership_index = MembershipIndex()
+
+@bot.event
+async def on_guild_join(guild):
+    membership_index.add_guild(guild)
+
+@bot.event
+async def on_guild_remove(guild):
+    membership_index.remove_guild(guild.id)
+
+@bot.event
+async def on_guild_update(before, after):
+    membership_index.update_summary(after)
+
+@bot.event
+async def on_member_join(member):
+    membership_index.add(member)
+    membership_index.update_summary(member.guild)
+
+@bot.event
+async def on_member_remove(member):
+    membership_index.remove(member.id, member.guild.id)
+    membership_index.update_summary(member.guild)
 
 # View user's servers
+SERVERS_PAGE_SIZE = 10
+
+def servers_page_embed(user, guilds, page):
+    pages = max(1, (len(guilds) + SERVERS_PAGE_SIZE - 1) // SERVERS_PAGE_SIZE)
+    embed = discord.Embed(
+        title=f'🌐 {user.display_name} が参加しているサーバー',
+        description=f'Botと共通のサーバー: {len(guilds)}個',
+        color=0x0099ff
+    )
+
+    for guild_id, join_date in guilds[page * SERVERS_PAGE_SIZE:(page + 1) * SERVERS_PAGE_SIZE]:
+        summary = membership_index.guild_summaries.get(guild_id, {})
+
+        # Roles are only shown when the member happens to be cached
+        guild = bot.get_guild(guild_id)
+        member = guild.get_member(user.id) if guild else None
+        roles = [role.name for role in member.roles if role.name != '@everyone'] if member else []
+        roles_text = ', '.join(roles[:3]) + ('...' if len(roles) > 3 else '') if roles else 'なし'
+
+        embed.add_field(
+            name=f'📋 {summary.get("name", guild_id)}',
+            value=f'**メンバー数:** {summary.get("member_count", "不明")}\n**参加日:** {join_date or "不明"}\n**ロール:** {roles_text}',
+            inline=True
+        )
+
+    embed.set_footer(text=f'総サーバー数: {len(guilds)} | ページ {page + 1}/{pages}')
+    return embed
+
+class ServersView(BaseView):
+    def __init__(self, user, guilds):
+        super().__init__(timeout=300)
+        self.user = user
+        self.guilds = guilds
+        self.page = 0
+        self.pages = (len(guilds) + SERVERS_PAGE_SIZE - 1) // SERVERS_PAGE_SIZE
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.pages - 1
+
+    async def show_page(self, interaction, page):
+        self.page = page
+        self.update_buttons()
+        await interaction.response.edit_message(embed=servers_page_embed(self.user, self.guilds, self.page), view=self)
+
+    @discord.ui.button(label='前へ', style=discord.ButtonStyle.secondary, emoji='◀')
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page - 1)
+
+    @discord.ui.button(label='次へ', style=discord.ButtonStyle.secondary, emoji='▶')
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page + 1)
+
 @bot.tree.command(name='servers', description='ユーザーが参加しているサーバー一覧を表示')
 async def view_servers(interaction: discord.Interaction, user: discord.Member = None):
     if user is None:
         user = interaction.user
 
-    # Get all mutual guilds between the bot and the user
-    mutual_guilds = user.mutual_guilds
+    guilds = membership_index.guilds_for(user)
 
-    if not mutual_guilds:
+    if not guilds:
         await interaction.response.send_message(f'❌ {user.display_name} との共通サーバーが見つかりません。')
         return
 
-    embed = discord.Embed(
-        title=f'🌐 {user.display_name} が参加しているサーバー',
-        description=f'Botと共通のサーバー: {len(mutual_guilds)}個',
-        color=0x0099ff
+    embed = servers_page_embed(user, guilds, 0)
+    if len(guilds) > SERVERS_PAGE_SIZE:
+        await interaction.response.send_message(embed=embed, view=ServersView(user, guilds))
+    else:
+        await interaction.response.send_message(embed=embed)
+
+# Rate limit settings
+@bot.tree.command(name='ratelimit', description='コマンドのレート制限を設定')
+async def set_rate_limit(interaction: discord.Interaction, command_class: Literal['purchase', 'read', 'auth', 'ticket'],
+                         capacity: app_commands.Range[int, 1, 1000], seconds: app_commands.Range[int, 1, 3600]):
+    if not interaction.user.guild_permissions.manage_guild:
+        await interaction.response.send_message('❌ サーバー管理権限が必要です。', ephemeral=True)
+        return
+
+    data = load_data()
+    guild_id = str(interaction.guild.id)
+    settings = data.setdefault('guild_settings', {}).setdefault(guild_id, {})
+    settings.setdefault('rate_limits', {})[command_class] = [capacity, seconds]
+    save_data(data)
+
+    rate_limiter.set_guild_limit(guild_id, command_class, capacity, seconds)
+    await interaction.response.send_message(f'✅ {command_class} のレート制限を {seconds} 秒あたり {capacity} 回に設定しました。')
+
+# Scheduled jobs
+# Periodic per-guild jobs, configured in data['guild_settings'][guild_id]['jobs'].
+# Schedules are cron expressions (minute hour day month weekday, local time)
+# supporting *, lists, ranges and steps. Jobs that fall due together run as one
+# batch with a single load/save, and a job that is still running for a guild is
+# skipped rather than started a second time.
+JOB_DEFAULT_JITTER = 60  # seconds
+JOB_MAX_SLEEP = 60  # re-check the clock at least this often
+
+class CronSpec:
+    FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 7))
+
+    def __init__(self, expression):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError('cron expression needs 5 fields: minute hour day month weekday')
+        self.expression = ' '.join(parts)
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self.parse_field(part, name, low, high) for part, (name, low, high) in zip(parts, self.FIELDS)
+        )
+        # 0 and 7 are both Sunday
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        # As in cron, a restricted day and weekday match if either one does
+        self.any_day = parts[2].startswith('*')
+        self.any_weekday = parts[4].startswith('*')
+
+    @staticmethod
+    def parse_field(field, name, low, high):
+        values = set()
+        for part in field.split(','):
+            base, _, step = part.partition('/')
+            try:
+                step = int(step) if step else 1
+                if base == '*':
+                    start, end = low, high
+                elif '-' in base:
+                    start, end = (int(value) for value in base.split('-', 1))
+                else:
+                    start = int(base)
+                    end = high if step > 1 or '/' in part else start
+            except ValueError:
+                raise ValueError(f'invalid {name} field: {field}') from None
+            if step < 1 or not low <= start <= end <= high:
+                raise ValueError(f'{name} must be between {low} and {high}: {field}')
+            values.update(range(start, end + 1, step))
+        return values
+
+    def day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, dt):
+        """Return the first matching minute after dt"""
+        t = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Anything that can match at all (even Feb 29 on a given weekday) does within 28 years
+        limit = t + timedelta(days=366 * 28)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f'"{self.expression}" never matches')
+
+# Each job mutates data in memory and returns (summary, followup), where
+# followup is an optional coroutine function run once the batch is saved.
+def run_daily_rewards(data, guild_id, config, now):
+    coins = config['value']
+    rewarded = {}
+    for user_id, user in data['users'].items():
+        if user.get('authenticated') and guild_id in user.get('guilds', ()):
+            user['coins'] += coins
+            rewarded[user_id] = user
+
+    async def followup():
+        for user_id, user in rewarded.items():
+            leaderboard.update(user_id, user)
+
+    return {'users': len(rewarded), 'coins': coins}, followup
+
+def run_restock(data, guild_id, config, now):
+    level = config['value']
+    items = data['vending_machines'].get(guild_id, {}).get('items', {})
+    restocked = {}
+    for item_id, item in items.items():
+        if item['stock'] < level:
+            item['stock'] = level
+            restocked[item_id] = item
+
+    async def followup():
+        for item_id, item in restocked.items():
+            refresh_flash_sale(guild_id, item_id, item)
+            index_item(guild_id, item_id, item)
+
+    return {'items': len(restocked)}, followup
+
+def run_ticket_autoclose(data, guild_id, config, now):
+    idle = timedelta(hours=config['value'])
+    closed = []
+    for ticket_id, ticket in data['tickets'].items():
+        if ticket['status'] != 'open' or ticket['guild_id'] != guild_id:
+            continue
+
+        # The channel's last message id is kept up to date by the gateway, so
+        # activity is known without fetching history
+        channel = bot.get_channel(int(ticket['channel_id'])) if ticket.get('channel_id') else None
+        last_activity = datetime.fromisoformat(ticket['created_at'])
+        if channel is not None and channel.last_message_id:
+            last_message_at = discord.utils.snowflake_time(channel.last_message_id).astimezone().replace(tzinfo=None)
+            last_activity = max(last_activity, last_message_at)
+        if now - last_activity < idle:
+            continue
+
+        ticket['status'] = 'closed'
+        ticket['closed_at'] = now.isoformat()
+        ticket['closed_by'] = str(bot.user.id) if bot.user else None
+        closed.append((ticket_id, channel))
+
+    async def followup():
+        for ticket_id, channel in closed:
+            if channel is None:
+                continue
+            try:
+                await channel.send(f'🔒 {config["value"]}時間操作がなかったため、チケット #{ticket_id} を自動でクローズしました。')
+                await archive_ticket(ticket_id, channel)
+            except Exception:
+                logger.exception('Failed to archive auto-closed ticket', extra={'ticket_id': ticket_id})
+
+    return {'tickets': len(closed)}, followup
+
+# name -> (job function, default schedule, default value, description of value)
+JOBS = {
+    'daily_rewards': (run_daily_rewards, '0 0 * * *', 10, '付与するコイン数'),
+    'restock': (run_restock, '0 * * * *', 10, '補充後の在庫数'),
+    'ticket_autoclose': (run_ticket_autoclose, '*/30 * * * *', 72, 'クローズまでの無操作時間')
+}
+
+def job_config(settings, name):
+    """Return the guild's config for a job with defaults filled in"""
+    _, schedule, value, _ = JOBS[name]
+    config = {'enabled': False, 'schedule': schedule, 'value': value, 'jitter': JOB_DEFAULT_JITTER}
+    config.update(settings.get('jobs', {}).get(name, {}))
+    return config
+
+class JobScheduler:
+    def __init__(self):
+        self.entries = {}  # (job name, guild id) -> {'spec', 'config', 'next_run'}
+        self.running = set()
+        self.tasks = set()
+        self.loop_task = None
+        self.wakeup = asyncio.Event()
+        self.job_stats = {
+            name: {'runs': 0, 'failures': 0, 'skipped': 0, 'last_duration_ms': None, 'max_duration_ms': 0,
+                   'last_lag_ms': None, 'max_lag_ms': 0}
+            for name in JOBS
+        }
+        self.batches = 0
+
+    def schedule_next(self, entry, now):
+        jitter = entry['config']['jitter']
+        entry['next_run'] = entry['spec'].next_after(now) + timedelta(seconds=random.uniform(0, jitter))
+
+    def configure(self, guild_id, name, config):
+        key = (name, guild_id)
+        if not config['enabled']:
+            self.entries.pop(key, None)
+            return None
+        entry = self.entries[key] = {'spec': CronSpec(config['schedule']), 'config': config}
+        self.schedule_next(entry, datetime.now())
+        self.wakeup.set()
+        return entry['next_run']
+
+    def load(self, data):
+        for guild_id, settings in data.get('guild_settings', {}).items():
+            for name in settings.get('jobs', {}):
+                if name not in JOBS:
+                    continue
+                try:
+                    self.configure(guild_id, name, job_config(settings, name))
+                except ValueError:
+                    logger.warning('Ignoring job with invalid schedule', extra={'job': name, 'guild_id': guild_id})
+
+    def start(self):
+        if self.loop_task is None:
+            self.loop_task = asyncio.create_task(self.run())
+
+    def stop(self):
+        """Stop starting batches; running ones are in self.tasks for the caller to await"""
+        if self.loop_task is not None:
+            self.loop_task.cancel()
+
+    async def run(self):
+        while True:
+            now = datetime.now()
+            due = [key for key, entry in self.entries.items() if entry['next_run'] <= now]
+            if due:
+                self.dispatch(due, now)
+
+            next_run = min((entry['next_run'] for entry in self.entries.values()), default=None)
+            timeout = JOB_MAX_SLEEP
+            if next_run is not None:
+                timeout = min(timeout, max(0, (next_run - datetime.now()).total_seconds()))
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def dispatch(self, due, now):
+        batch = []
+        for key in due:
+            entry = self.entries[key]
+            scheduled = entry['next_run']
+            self.schedule_next(entry, now)
+            if key in self.running:
+                self.job_stats[key[0]]['skipped'] += 1
+                logger.warning('Skipping job run; the previous run is still going',
+                               extra={'job': key[0], 'guild_id': key[1]})
+                continue
+            self.running.add(key)
+            batch.append((key, entry['config'], scheduled))
+
+        if batch:
+            task = asyncio.create_task(self.run_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run_batch(self, batch):
+        started = datetime.now()
+        results = []
+        try:
+            # No awaits between load and save, so handlers cannot interleave
+            data = load_data()
+            for key, config, scheduled in batch:
+                name, guild_id = key
+                stats = self.job_stats[name]
+                lag_ms = round((started - scheduled).total_seconds() * 1000, 1)
+                stats['last_lag_ms'] = lag_ms
+                stats['max_lag_ms'] = max(stats['max_lag_ms'], lag_ms)
+
+                start = time.monotonic()
+                try:
+                    summary, followup = JOBS[name][0](data, guild_id, config, started)
+                except Exception:
+                    stats['failures'] += 1
+                    logger.exception('Job failed', extra={'job': name, 'guild_id': guild_id})
+                    continue
+                results.append((key, summary, followup, time.monotonic() - start))
+            save_data(data)
+            self.batches += 1
+
+            await asyncio.gather(*(self.finish(*result) for result in results))
+        finally:
+            self.running.difference_update(key for key, _, _ in batch)
+
+    async def finish(self, key, summary, followup, elapsed):
+        name, guild_id = key
+        stats = self.job_stats[name]
+        start = time.monotonic()
+        try:
+            if followup is not None:
+                await followup()
+        except Exception:
+            stats['failures'] += 1
+            logger.exception('Job follow-up failed', extra={'job': name, 'guild_id': guild_id})
+            return
+
+        duration_ms = round((elapsed + time.monotonic() - start) * 1000, 1)
+        stats['runs'] += 1
+        stats['last_duration_ms'] = duration_ms
+        stats['max_duration_ms'] = max(stats['max_duration_ms'], duration_ms)
+        logger.info('Job finished', extra={'job': name, 'guild_id': guild_id, 'duration_ms': duration_ms, **summary})
+
+    def stats(self):
+        return {'scheduled': len(self.entries), 'running': len(self.running), 'batches': self.batches, 'jobs': self.job_stats}
+
+job_scheduler = JobScheduler()
+
+@bot.tree.command(name='job', description='定期ジョブを設定')
+async def configure_job(interaction: discord.Interaction, job: Literal['daily_rewards', 'restock', 'ticket_autoclose'],
+                        enabled: bool, schedule: str = None, value: app_commands.Range[int, 1, 100000] = None,
+                        jitter: app_commands.Range[int, 0, 3600] = None):
+    if not interaction.user.guild_permissions.manage_guild:
+        await interaction.response.send_message('❌ サーバー管理権限が必要です。', ephemeral=True)
+        return
+
+    data = load_data()
+    guild_id = str(interaction.guild.id)
+    settings = data.setdefault('guild_settings', {}).setdefault(guild_id, {})
+    config = job_config(settings, job)
+    config['enabled'] = enabled
+    for key, option in (('schedule', schedule), ('value', value), ('jitter', jitter)):
+        if option is not None:
+            config[key] = option
+
+    try:
+        CronSpec(config['schedule']).next_after(datetime.now())
+    except ValueError as e:
+        await interaction.response.send_message(f'❌ スケジュールが不正です: {e}', ephemeral=True)
+        return
+
+    settings.setdefault('jobs', {})[job] = config
+    save_data(data)
+
+    next_run = job_scheduler.configure(guild_id, job, config)
+    if next_run is None:
+        await interaction.response.send_message(f'✅ {job} を無効にしました。')
+        return
+
+    await interaction.response.send_message(
+        f'✅ {job} を `{config["schedule"]}` に設定しました（{JOBS[job][3]}: {config["value"]}）。\n'
+        f'次回実行: <t:{int(next_run.timestamp())}:F>'
     )
 
-    for guild in mutual_guilds:
-        # Get member object for this guild
-        member = guild.get_member(user.id)
-        if member:
-            # Get join date
-            joined_at = member.joined_at
-            join_date = joined_at.strftime('%Y/%m/%d') if joined_at else '不明'
-            
-            # Get member count
-            member_count = guild.member_count
-            
-            # Get user's roles in this guild (excluding @everyone)
-            roles = [role.name for role in member.roles if role.name != '@everyone']
-            roles_text = ', '.join(roles[:3]) + ('...' if len(roles) > 3 else '') if roles else 'なし'
-            
-            embed.add_field(
-                name=f'📋 {guild.name}',
-                value=f'**メンバー数:** {member_count}\n**参加日:** {join_date}\n**ロール:** {roles_text}',
-                inline=True
-            )
+# Data export
+EXPORT_COOLDOWN = int(os.getenv('EXPORT_COOLDOWN', '300'))  # seconds between exports per guild
+TRANSACTION_EXPORT_FIELDS = ['timestamp', 'guild_id', 'user_id', 'item_name', 'price']
+TICKET_EXPORT_FIELDS = ['ticket_id', 'guild_id', 'user_id', 'subject', 'description', 'status',
+                        'created_at', 'closed_at', 'closed_by', 'channel_id']
+last_export_at = {}
+
+def export_rows(data, kind, guild_id, since=None, until=None):
+    """Yield the guild's transactions or tickets created in [since, until)"""
+    if kind == 'transactions':
+        for transaction in iter_transactions(data, since, until):
+            if transaction.get('guild_id') == guild_id:
+                yield transaction
+        return
 
-    embed.set_footer(text=f'総サーバー数: {len(mutual_guilds)}')
-    await interaction.response.send_message(embed=embed)
+    since = since.isoformat() if since else None
+    until = until.isoformat() if until else None
+    for ticket_id, ticket in data['tickets'].items():
+        created_at = ticket.get('created_at', '')
+        if ticket.get('guild_id') != guild_id:
+            continue
+        if (since and created_at < since) or (until and created_at >= until):
+            continue
+        yield {'ticket_id': ticket_id, **ticket}
+
+def write_export(rows, fields, fmt):
+    """Stream rows into a gzip-compressed temp file, returning (path, row count)"""
+    fd, path = tempfile.mkstemp(prefix='export-', suffix=f'.{fmt}.gz')
+    os.close(fd)
+
+    count = 0
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+                count += 1
+    return path, count
+
+@bot.tree.command(name='export', description='取引履歴またはチケットをファイルで出力')
+@app_commands.rename(start='from', end='to')
+async def export_data(interaction: discord.Interaction, kind: Literal['transactions', 'tickets'],
+                      start: str = None, end: str = None, fmt: Literal['csv', 'jsonl'] = 'csv'):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message('❌ 管理者権限が必要です。', ephemeral=True)
+        return
+
+    try:
+        since = datetime.strptime(start, '%Y-%m-%d') if start else None
+        # The end date is inclusive
+        until = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) if end else None
+    except ValueError:
+        await interaction.response.send_message('❌ 日付は YYYY-MM-DD 形式で指定してください。', ephemeral=True)
+        return
+
+    guild_id = str(interaction.guild.id)
+    now = time.monotonic()
+    if guild_id in last_export_at and now - last_export_at[guild_id] < EXPORT_COOLDOWN:
+        remaining = int(EXPORT_COOLDOWN - (now - last_export_at[guild_id])) + 1
+        await interaction.response.send_message(f'❌ エクスポートは {remaining} 秒後に再度実行できます。', ephemeral=True)
+        return
+    last_export_at[guild_id] = now
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    data = load_data()
+    fields = TRANSACTION_EXPORT_FIELDS if kind == 'transactions' else TICKET_EXPORT_FIELDS
+    path = None
+    try:
+        path, count = await asyncio.to_thread(write_export, export_rows(data, kind, guild_id, since, until), fields, fmt)
+
+        if os.path.getsize(path) > interaction.guild.filesize_limit:
+            await interaction.followup.send('❌ ファイルサイズが上限を超えています。期間を絞って再度お試しください。', ephemeral=True)
+            return
+
+        filename = f'{kind}-{guild_id}-{datetime.now().strftime("%Y%m%d%H%M%S")}.{fmt}.gz'
+        await interaction.followup.send(
+            f'✅ {count} 件をエクスポートしました。',
+            file=discord.File(path, filename=filename),
+            ephemeral=True
+        )
+    except Exception as e:
+        logger.exception('Export failed', extra={'kind': kind, 'guild_id': guild_id})
+        await interaction.followup.send(f'❌ エクスポートに失敗しました: {str(e)}', ephemeral=True)
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+# Profiling and loop watchdog
+PROFILE_INTERVAL = 0.005  # seconds between stack samples
+PROFILE_MAX_SECONDS = 60
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', '0.5'))  # seconds
+DEBUG_TOKEN = os.getenv('DEBUG_TOKEN')
+profile_lock = threading.Lock()
+
+def format_frame(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+def sample_stacks(seconds, interval=PROFILE_INTERVAL):
+    """Sample every thread's stack for `seconds` and return them in collapsed-stack format.
+
+    Each output line is ``thread;outer;...;inner count``, which flamegraph.pl and
+    speedscope read directly.
+    """
+    counts = Counter()
+    own_id = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(format_frame(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+
+    return ''.join(f'{stack} {count}\n' for stack, count in counts.most_common())
+
+def run_profile(seconds):
+    """Run sample_stacks unless a profile is already running; returns None if busy"""
+    if not profile_lock.acquire(blocking=False):
+        return None
+    try:
+        return sample_stacks(min(seconds, PROFILE_MAX_SECONDS))
+    finally:
+        profile_lock.release()
+
+class LoopWatchdog:
+    """Logs the event loop thread's stack whenever a callback blocks the loop too long.
+
+    A heartbeat callback on the loop records when it last ran; a monitor thread
+    notices when it falls behind by more than the threshold.
+    """
+
+    def __init__(self, threshold=LOOP_STALL_THRESHOLD):
+        self.threshold = threshold
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = time.monotonic()
+        self.stalls = 0
+        self.longest_stall = 0.0
+
+    def start(self, loop):
+        if self.loop is not None:
+            return
+        self.loop = loop
+        self.loop_thread_id = threading.get_ident()
+        self.beat()
+        Thread(target=self.monitor, name='loop-watchdog', daemon=True).start()
+
+    def beat(self):
+        self.last_beat = time.monotonic()
+        self.loop.call_later(self.threshold / 4, self.beat)
+
+    def monitor(self):
+        reported_beat = None
+        while True:
+            time.sleep(self.threshold / 4)
+            if self.loop.is_closed():
+                return
+            beat = self.last_beat
+            lag = time.monotonic() - beat
+            if lag < self.threshold:
+                continue
+            self.longest_stall = max(self.longest_stall, lag)
+            # Report each stall once, while it is still blocking
+            if beat == reported_beat:
+                continue
+            reported_beat = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame else '(unavailable)'
+            logger.warning('Event loop blocked for %.3fs:\n%s', lag, stack)
+
+    def stats(self):
+        return {'stalls': self.stalls, 'longest_stall': round(self.longest_stall, 3), 'threshold': self.threshold}
+
+loop_watchdog = LoopWatchdog()
+
+debug_group = app_commands.Group(name='debug', description='デバッグ用コマンド')
+
+@debug_group.command(name='profile', description='ボットのプロファイルを取得')
+async def debug_profile(interaction: discord.Interaction, seconds: app_commands.Range[int, 1, PROFILE_MAX_SECONDS] = 10):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message('❌ 管理者権限が必要です。', ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    stacks = await asyncio.to_thread(run_profile, seconds)
+    if stacks is None:
+        await interaction.followup.send('❌ 別のプロファイルを実行中です。', ephemeral=True)
+        return
+
+    filename = f'profile-{datetime.now().strftime("%Y%m%d%H%M%S")}.collapsed.txt'
+    await interaction.followup.send(
+        f'✅ {seconds}秒間のプロファイルを取得しました。',
+        file=discord.File(io.BytesIO(stacks.encode('utf-8')), filename=filename),
+        ephemeral=True
+    )
+
+bot.tree.add_command(debug_group)
+
+# Autocomplete
+async def item_id_autocomplete(interaction: discord.Interaction, current: str):
+    index = get_item_index(str(interaction.guild.id))
+    return [app_commands.Choice(name=label, value=item_id) for label, item_id in index.search(current)]
+
+async def role_name_autocomplete(interaction: discord.Interaction, current: str):
+    index = get_role_index(interaction.guild)
+    return [app_commands.Choice(name=name, value=name) for name in index.search(current)]
+
+for command in (buy_item, delete_item, change_price, add_stock, toggle_flash_sale):
+    command.autocomplete('item_id')(item_id_autocomplete)
+
+for command in (auth, setup_role):
+    command.autocomplete('role_name')(role_name_autocomplete)
+
+@bot.event
+async def on_guild_role_create(role):
+    role_indexes.pop(role.guild.id, None)
+
+@bot.event
+async def on_guild_role_delete(role):
+    role_indexes.pop(role.guild.id, None)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    role_indexes.pop(after.guild.id, None)
 
 # Help system
 COMMAND_HELP = {
@@ -970,6 +3180,16 @@ COMMAND_HELP = {
         'usage': '/addcoins <ユーザー> <数量>',
         'details': '指定したユーザーにコインを追加します。管理者用コマンドです。'
     },
+    'addcoins-role': {
+        'description': 'ロールを持つ全員にコインを追加',
+        'usage': '/addcoins-role <ロール> <数量>',
+        'details': '指定したロールを持つ全メンバー（Botを除く）にコインを一括で追加します。進捗はメッセージを更新して表示されます。サーバー管理権限が必要です。'
+    },
+    'addcoins-schedule': {
+        'description': '指定時間後にロールを持つ全員にコインを追加',
+        'usage': '/addcoins-schedule <ロール> <数量> <分>',
+        'details': '指定した分数の後に /addcoins-role と同じ一括付与を実行します。予約はボットの再起動で取り消されます。サーバー管理権限が必要です。'
+    },
     'del': {
         'description': '自動販売機からアイテムを削除',
         'usage': '/del <アイテムID>',
@@ -985,6 +3205,11 @@ COMMAND_HELP = {
         'usage': '/additem <アイテムID> <数量>',
         'details': '指定したアイテムの在庫を追加します。'
     },
+    'importitems': {
+        'description': 'ファイルから自動販売機のアイテムを一括登録',
+        'usage': '/importitems <ファイル> [upsert]',
+        'details': 'name,price,stock 列のCSV、または同じキーを持つオブジェクト配列のJSONを添付すると、アイテムをまとめて登録します。upsertが有効な場合、同じ名前のアイテムは価格と在庫が更新されます。サーバー管理権限が必要です。'
+    },
     'buy': {
         'description': '自動販売機からアイテムを購入',
         'usage': '/buy <アイテムID>',
@@ -1005,6 +3230,11 @@ COMMAND_HELP = {
         'usage': '/tickets',
         'details': 'サーバー内の全チケットの一覧を表示します。管理者用コマンドです。'
     },
+    'transcript': {
+        'description': 'クローズしたチケットのトランスクリプトを取得',
+        'usage': '/transcript <チケットID>',
+        'details': 'チケットをクローズした時に保存されたメッセージ履歴（gzip圧縮のJSONL）を送信します。チケットの作成者と管理者のみ利用できます。'
+    },
     'nuke': {
         'description': 'チャンネルを再生成（設定を引き継ぎ）',
         'usage': '/nuke',
@@ -1015,6 +3245,36 @@ COMMAND_HELP = {
         'usage': '/profile [ユーザー]',
         'details': '指定したユーザー（省略時は自分）のプロフィール情報を表示します。'
     },
+    'leaderboard': {
+        'description': 'コインランキングを表示',
+        'usage': '/leaderboard [server|global] [件数]',
+        'details': 'コイン所持数のランキングを表示します。serverはこのサーバーで利用したユーザー、globalは全ユーザーが対象です。あなたの順位も表示されます。'
+    },
+    'export': {
+        'description': '取引履歴またはチケットをファイルで出力',
+        'usage': '/export <transactions|tickets> [from] [to] [csv|jsonl]',
+        'details': 'サーバーの取引履歴またはチケットをgzip圧縮したCSV/JSONLファイルで出力します。期間はYYYY-MM-DD形式で指定します。管理者用コマンドで、サーバーごとに一定時間に1回まで実行できます。'
+    },
+    'ratelimit': {
+        'description': 'コマンドのレート制限を設定',
+        'usage': '/ratelimit <purchase|read|auth|ticket> <回数> <秒数>',
+        'details': 'このサーバーでのユーザーごとのレート制限を設定します。サーバー全体の上限はその10倍になります。サーバー管理権限が必要です。'
+    },
+    'flashsale': {
+        'description': 'アイテムのフラッシュセールモードを切り替え',
+        'usage': '/flashsale <アイテムID> <有効/無効>',
+        'details': '在庫の少ない人気アイテム向けのモードです。購入リクエストを受付順に1件ずつ処理し、売り切れ後のリクエストは即座に断ります。サーバー管理権限が必要です。'
+    },
+    'job': {
+        'description': '定期ジョブを設定',
+        'usage': '/job <daily_rewards|restock|ticket_autoclose> <有効/無効> [スケジュール] [値] [ジッター秒数]',
+        'details': '定期ジョブを設定します。スケジュールはcron形式（分 時 日 月 曜日）で、daily_rewardsは認証済みメンバーに毎回付与するコイン数、restockは補充後の在庫数、ticket_autocloseはクローズまでの無操作時間を値として指定します。サーバー管理権限が必要です。'
+    },
+    'debug': {
+        'description': 'デバッグ用コマンド',
+        'usage': '/debug profile [秒数]',
+        'details': '指定した秒数（最大60秒）の間ボットの処理をサンプリングし、collapsed stack形式のファイルを送信します。管理者用コマンドです。'
+    },
     'help': {
         'description': 'ヘルプを表示',
         'usage': '/help [コマンド名]',
@@ -1028,7 +3288,7 @@ COMMAND_HELP = {
     'servers': {
         'description': 'ユーザーが参加しているサーバー一覧を表示',
         'usage': '/servers [ユーザー]',
-        'details': '指定したユーザー（省略時は自分）が参加している共通サーバーの一覧を表示します。各サーバーのメンバー数、参加日、ロール情報も含まれます。'
+        'details': '指定したユーザー（省略時は自分）が参加している共通サーバーの一覧を表示します。各サーバーのメンバー数、参加日、ロール情報も含まれます。10件を超える場合はボタンでページを切り替えられます。'
     },
     'setuprole': {
         'description': 'ロール取得パネルを設置',
@@ -1037,63 +3297,153 @@ COMMAND_HELP = {
     }
 }
 
+# Help embeds are rendered once per COMMAND_HELP and served from help_cache
+HELP_FIELDS_PER_EMBED = 25  # Discord's limit on fields per embed
+HELP_SUGGESTIONS = 3
+help_cache = {}
+
+def build_help_overview():
+    """Render the command list, split over several embeds when it exceeds the field limit"""
+    names = list(COMMAND_HELP)
+    chunks = [names[i:i + HELP_FIELDS_PER_EMBED] for i in range(0, len(names), HELP_FIELDS_PER_EMBED)]
+    embeds = []
+    for i, chunk in enumerate(chunks):
+        embed = discord.Embed(color=0x0099ff)
+        if i == 0:
+            embed.title = '🤖 ボットコマンド一覧'
+            embed.description = '使用可能なコマンドの一覧です。詳細は `/help コマンド名` で確認できます。'
+        for cmd_name in chunk:
+            embed.add_field(name=f'/{cmd_name}', value=COMMAND_HELP[cmd_name]['description'], inline=False)
+        if i == len(chunks) - 1:
+            embed.set_footer(text='例: /help auth - authコマンドの詳細を表示')
+        embeds.append(freeze_embed(embed))
+    return tuple(embeds)
+
+def build_command_help(command, cmd_info):
+    embed = discord.Embed(title=f'📖 /{command} コマンドヘルプ', color=0x00ff00)
+    embed.add_field(name='説明', value=cmd_info['description'], inline=False)
+    embed.add_field(name='使用方法', value=f"`{cmd_info['usage']}`", inline=False)
+    embed.add_field(name='詳細', value=cmd_info['details'], inline=False)
+    return freeze_embed(embed)
+
+def reload_command_help(command_help=None):
+    """Replace COMMAND_HELP if given and rebuild help_cache from it"""
+    global COMMAND_HELP
+    if command_help is not None:
+        COMMAND_HELP = command_help
+
+    # SequenceMatcher caches its analysis of the second sequence, so each
+    # command name is analysed once here rather than on every lookup
+    matchers = []
+    for cmd_name in COMMAND_HELP:
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(cmd_name)
+        matchers.append((cmd_name, matcher))
+
+    help_cache.clear()
+    help_cache.update({
+        'overview': build_help_overview(),
+        'commands': {cmd_name: build_command_help(cmd_name, cmd_info) for cmd_name, cmd_info in COMMAND_HELP.items()},
+        'matchers': matchers
+    })
+
+def suggest_commands(command, limit=HELP_SUGGESTIONS, cutoff=0.6):
+    """Return up to limit command names similar to command, closest first"""
+    scored = []
+    for cmd_name, matcher in help_cache['matchers']:
+        matcher.set_seq1(command)
+        if matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff:
+            ratio = matcher.ratio()
+            if ratio >= cutoff:
+                scored.append((ratio, cmd_name))
+    scored.sort(key=lambda entry: -entry[0])
+    return [cmd_name for _, cmd_name in scored[:limit]]
+
+reload_command_help()
+
 @bot.tree.command(name='help', description='ヘルプを表示')
 async def help_command(interaction: discord.Interaction, command: str = None):
     if command is None:
         # Show all commands
-        embed = discord.Embed(
-            title='🤖 ボットコマンド一覧',
-            description='使用可能なコマンドの一覧です。詳細は `/help コマンド名` で確認できます。',
-            color=0x0099ff
-        )
-
-        for cmd_name, cmd_info in COMMAND_HELP.items():
-            embed.add_field(
-                name=f"/{cmd_name}",
-                value=cmd_info['description'],
-                inline=False
-            )
+        await interaction.response.send_message(embeds=[static_embed(frozen) for frozen in help_cache['overview']])
+        return
 
-        embed.set_footer(text="例: /help auth - authコマンドの詳細を表示")
-        await interaction.response.send_message(embed=embed)
+    # Show specific command help
+    command = command.strip().lstrip('/').lower()
+    frozen = help_cache['commands'].get(command)
+    if frozen is not None:
+        await interaction.response.send_message(embed=static_embed(frozen))
+        return
 
+    suggestions = suggest_commands(command)
+    if suggestions:
+        hint = 'もしかして: ' + ', '.join(f'`/{cmd_name}`' for cmd_name in suggestions)
     else:
-        # Show specific command help
-        if command in COMMAND_HELP:
-            cmd_info = COMMAND_HELP[command]
-            embed = discord.Embed(
-                title=f'📖 /{command} コマンドヘルプ',
-                color=0x00ff00
-            )
-            embed.add_field(name='説明', value=cmd_info['description'], inline=False)
-            embed.add_field(name='使用方法', value=f"`{cmd_info['usage']}`", inline=False)
-            embed.add_field(name='詳細', value=cmd_info['details'], inline=False)
+        hint = '利用可能なコマンド: ' + ', '.join(COMMAND_HELP)
+    await interaction.response.send_message(f'❌ コマンド "{command}" が見つかりません。\n{hint}')
 
-            await interaction.response.send_message(embed=embed)
-        else:
-            available_commands = ', '.join(COMMAND_HELP.keys())
-            await interaction.response.send_message(
-                f'❌ コマンド "{command}" が見つかりません。\n'
-                f'利用可能なコマンド: {available_commands}'
-            )
+async def shutdown(reason):
+    """Stop taking interactions, let in-flight handlers finish, then disconnect"""
+    global shutting_down
+    if shutting_down:
+        return
+    shutting_down = True
+    start = time.monotonic()
+
+    # Whatever happens below, the process exits within the deadline
+    Thread(target=lambda: (time.sleep(SHUTDOWN_DEADLINE), os._exit(1)), daemon=True).start()
+
+    # Running job batches save as they go, so let them finish like handlers
+    job_scheduler.stop()
+    pending = set(inflight_tasks) | set(job_scheduler.tasks)
+    logger.info('Shutting down', extra={'reason': reason, 'inflight': len(pending)})
+    if pending:
+        # Leave time for disconnecting and flushing logs
+        _, pending = await asyncio.wait(pending, timeout=SHUTDOWN_DEADLINE * 0.8)
+
+    # Handlers save synchronously, so once they are done there are no pending writes
+    for sale in list(flash_sales.values()):
+        sale.close()
+    for task in list(scheduled_grants):
+        task.cancel()
+    # Safe to interrupt: archived rows still in DATA_FILE are skipped next time
+    rotate_transactions_loop.cancel()
+
+    logger.info('Shutdown complete', extra={
+        'abandoned': len(pending),
+        'duration_ms': round((time.monotonic() - start) * 1000, 1)
+    })
+    await bot.close()
+
+async def start_bot(token):
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda sig=sig: asyncio.create_task(shutdown(sig.name)))
+
+    async with bot:
+        await bot.start(token)
 
 def run_bot():
     """Run Discord bot"""
     token = os.getenv('DISCORD_TOKEN')
     if not token:
-        print('DISCORD_TOKEN環境変数が設定されていません。')
+        logger.error('DISCORD_TOKEN環境変数が設定されていません。')
         return
 
-    print("Starting Discord bot...")
-    bot.run(token)
+    recover_data_file()
+
+    logger.info('Starting Discord bot...')
+    asyncio.run(start_bot(token))
 
 # Run the application
 if __name__ == '__main__':
+    setup_logging()
+
     # Start Flask server in a separate thread
     flask_thread = Thread(target=run_flask)
     flask_thread.daemon = True
     flask_thread.start()
-    print("Flask server started on port 5000")
+    logger.info('Flask server started on port 5000')
 
     # Start Discord bot
     run_bot()
@@ -0,0 +1,669 @@
+"""Offline maintenance for the bot's data file.
+
+The file is read as a stream, one user, vending machine, transaction or ticket at
+a time, so these commands run in bounded memory on files much larger than RAM.
+Stop the bot before rewriting its data file.
+
+Usage:
+  python maintenance.py stats [PATH]
+  python maintenance.py validate [PATH]
+  python maintenance.py compact [PATH] [-o OUT] [--drop-orphan-transactions]
+                                [--closed-ticket-days N] [--dedup-window N]
+  python maintenance.py migrate [PATH] --to {json,jsonl} [-o OUT]
+"""
+import argparse
+import itertools
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
+
+DATA_FILE = 'bot_data.json'
+# Keep in sync with main.SCHEMA_VERSION. Files without schema_version are version 0.
+SCHEMA_VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+MAX_VALUE_BYTES = 64 * 1024 * 1024  # largest single user/machine/transaction/ticket
+DEDUP_WINDOW = 100_000
+MAX_REPORTED_ERRORS = 50
+
+WHITESPACE = re.compile(r'[ \t\r\n]*')
+
+# Streaming reader
+class JsonReader:
+    """Incremental reader for a JSON document, one value at a time.
+
+    Containers are walked with keys() and elements(), which yield before each
+    member and expect the caller to consume it (with value() or another walk) before
+    resuming. Only the buffered chunk and the value being decoded are in memory.
+    """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.consumed = 0
+        self.eof = False
+
+    def offset(self):
+        return self.consumed + self.pos
+
+    def fill(self, size=None):
+        """Append the next chunk to the buffer; returns False at end of file"""
+        if self.eof:
+            return False
+        chunk = self.f.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.consumed += self.pos
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it ('' at end of file)"""
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f'expected {char!r} but found {found or "end of file"!r} at offset {self.offset()}')
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError as e:
+                # Probably cut off at the end of the buffer; read more, doubling each time
+                if len(self.buf) - self.pos > MAX_VALUE_BYTES or not self.fill(len(self.buf)):
+                    raise ValueError(f'{e.msg} at offset {self.consumed + e.pos}') from None
+                continue
+            # A number at the very end of the buffer may continue in the next chunk
+            if end == len(self.buf) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def walk(self, open_char, close_char):
+        self.expect(open_char)
+        if self.peek() == close_char:
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self.peek()
+            self.pos += 1
+            if char == close_char:
+                return
+            if char != ',':
+                raise ValueError(f'expected "," or {close_char!r} at offset {self.offset() - 1}')
+
+    def keys(self):
+        """Yield each key of the object at the current position; its value follows"""
+        for _ in self.walk('{', '}'):
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError(f'object key is not a string at offset {self.offset()}')
+            self.expect(':')
+            yield key
+
+    def elements(self):
+        """Yield once per element of the array at the current position; the element follows"""
+        return self.walk('[', ']')
+
+# Sections
+# A data file is a sequence of top-level sections, each an 'object' (users,
+# vending_machines, tickets, guild_settings), an 'array' (transactions) or a
+# 'scalar' (schema_version, ticket_counter). Readers yield (section, kind, entries) where
+# entries yields (key, value) pairs; keys are None outside objects.
+def read_json_sections(f):
+    reader = JsonReader(f)
+    for section in reader.keys():
+        char = reader.peek()
+        if char == '{':
+            kind, entries = 'object', ((key, reader.value()) for key in reader.keys())
+        elif char == '[':
+            kind, entries = 'array', ((None, reader.value()) for _ in reader.elements())
+        else:
+            kind, entries = 'scalar', iter([(None, reader.value())])
+        yield section, kind, entries
+        # Skip whatever the caller did not read
+        for _ in entries:
+            pass
+    if reader.peek():
+        raise ValueError(f'unexpected data after the top-level object at offset {reader.offset()}')
+
+def read_jsonl_sections(f):
+    """Read the JSON Lines layout: a {"section", "type"} header line, then one line per entry"""
+    def tagged():
+        header = None
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'section' in record:
+                header = (number, record['section'], record['type'])
+                yield header, None
+            elif header is None:
+                raise ValueError(f'line {number}: entry before any section header')
+            else:
+                yield header, record
+
+    for (_, section, kind), group in itertools.groupby(tagged(), key=lambda tagged_record: tagged_record[0]):
+        yield section, kind, ((record.get('key'), record['value']) for _, record in group if record is not None)
+
+def data_format(path):
+    return 'jsonl' if path.endswith('.jsonl') else 'json'
+
+def read_sections(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        if data_format(path) == 'jsonl':
+            yield from read_jsonl_sections(f)
+        else:
+            yield from read_json_sections(f)
+
+# Writers
+def dump_nested(value, level):
+    # json.dumps escapes newlines inside strings, so every newline is structural
+    return json.dumps(value, ensure_ascii=False, indent=2).replace('\n', '\n' + ' ' * level)
+
+class JsonWriter:
+    """Writes sections as one JSON object laid out like json.dump(indent=2) in main.save_data"""
+
+    def __init__(self, f):
+        self.f = f
+        self.sections = 0
+
+    def write_section(self, section, kind, entries):
+        self.f.write(',\n' if self.sections else '{\n')
+        self.sections += 1
+        name = json.dumps(section, ensure_ascii=False)
+        if kind == 'scalar':
+            (_, value), = entries
+            self.f.write(f'  {name}: {dump_nested(value, 2)}')
+            return 1
+
+        open_char, close_char = '{}' if kind == 'object' else '[]'
+        self.f.write(f'  {name}: {open_char}')
+        count = 0
+        for key, value in entries:
+            self.f.write(',\n    ' if count else '\n    ')
+            if kind == 'object':
+                self.f.write(json.dumps(key, ensure_ascii=False) + ': ')
+            self.f.write(dump_nested(value, 4))
+            count += 1
+        self.f.write(f'\n  {close_char}' if count else close_char)
+        return count
+
+    def close(self):
+        self.f.write('\n}' if self.sections else '{}')
+
+class JsonlWriter:
+    def __init__(self, f):
+        self.f = f
+
+    def write_section(self, section, kind, entries):
+        self.f.write(json.dumps({'section': section, 'type': kind}, ensure_ascii=False) + '\n')
+        count = 0
+        for key, value in entries:
+            record = {'key': key, 'value': value} if kind == 'object' else {'value': value}
+            self.f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            count += 1
+        return count
+
+    def close(self):
+        pass
+
+def write_sections(path, sections):
+    """Write (section, kind, entries) to path atomically; returns {section: entries written}.
+
+    An existing file at path is kept as path + '.bak', as main.save_data does.
+    """
+    tmp_path = path + '.tmp'
+    counts = {}
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        writer = JsonlWriter(f) if data_format(path) == 'jsonl' else JsonWriter(f)
+        for section, kind, entries in sections:
+            counts[section] = writer.write_section(section, kind, entries)
+        writer.close()
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(path):
+        snapshot_file(path, path + '.bak')
+    # path is swapped in one step, so it always exists
+    os.replace(tmp_path, path)
+    return counts
+
+def snapshot_file(path, snapshot_path):
+    """Replace snapshot_path with the current contents of path, leaving path in place"""
+    tmp_path = snapshot_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(path, tmp_path)
+    except OSError:
+        # Filesystems without hard links
+        shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, snapshot_path)
+
+# Schema
+# schema_version is always written as the first section, so a file's version is
+# known before any entry is read.
+SECTION_KINDS = {
+    'schema_version': 'scalar',
+    'users': 'object',
+    'vending_machines': 'object',
+    'transactions': 'array',
+    'tickets': 'object',
+    'guild_settings': 'object',
+    # Last ticket id issued (main.next_ticket_id); optional, written by upgrade()
+    'ticket_counter': 'scalar'
+}
+REQUIRED_SECTIONS = {'users', 'vending_machines', 'transactions', 'tickets'}
+
+# section -> field -> (allowed types, required)
+ENTRY_FIELDS = {
+    'users': {
+        'coins': (int, True),
+        'authenticated': (bool, True),
+        'join_date': (str, False),
+        'guilds': (list, False)
+    },
+    'items': {
+        'name': (str, True),
+        'price': (int, True),
+        'stock': (int, True),
+        'created_by': (str, False),
+        'flash_sale': (bool, False)
+    },
+    'transactions': {
+        'user_id': (str, True),
+        'item_name': (str, True),
+        'price': (int, True),
+        'timestamp': (str, True),
+        'guild_id': (str, True)
+    },
+    'tickets': {
+        'user_id': (str, True),
+        'subject': (str, True),
+        'description': (str, False),
+        'status': (str, True),
+        'created_at': (str, True),
+        'guild_id': (str, True),
+        'channel_id': (str, False),
+        'closed_at': (str, False),
+        'closed_by': ((str, type(None)), False),
+        'transcript': (dict, False),
+        'channel_deleted': (bool, False)
+    },
+    'guild_settings': {
+        'rate_limits': (dict, False),
+        'jobs': (dict, False)
+    }
+}
+
+def is_type(value, types):
+    # bool is a subclass of int, but a boolean coin count is still wrong
+    types = types if isinstance(types, tuple) else (types,)
+    if isinstance(value, bool) and bool not in types:
+        return False
+    return isinstance(value, types)
+
+def check_fields(errors, where, value, fields):
+    if not isinstance(value, dict):
+        errors.append(f'{where}: expected an object')
+        return
+    for field, (types, required) in fields.items():
+        if field not in value:
+            if required:
+                errors.append(f'{where}: missing "{field}"')
+        elif not is_type(value[field], types):
+            errors.append(f'{where}: "{field}" has the wrong type')
+
+def entry_errors(section, key, value):
+    """Return the schema errors of one entry"""
+    errors = []
+    where = f'{section}[{key!r}]' if key is not None else section
+    if section == 'vending_machines':
+        if not isinstance(value, dict) or not isinstance(value.get('items'), dict):
+            errors.append(f'{where}: "items" is missing or not an object')
+            return errors
+        for item_id, item in value['items'].items():
+            check_fields(errors, f'{where}.items[{item_id!r}]', item, ENTRY_FIELDS['items'])
+    elif section in ('schema_version', 'ticket_counter'):
+        if not is_type(value, int):
+            errors.append(f'{where}: expected an integer')
+    elif section in ENTRY_FIELDS:
+        check_fields(errors, where, value, ENTRY_FIELDS[section])
+        if section == 'tickets' and value.get('status') not in ('open', 'closed'):
+            errors.append(f'{where}: unknown status {value.get("status")!r}')
+    return errors
+
+def schema_version(path):
+    """Read the version from the first section without reading the rest of the file"""
+    for section, _, entries in read_sections(path):
+        if section == 'schema_version':
+            return next(entries)[1]
+        return 0
+    return 0
+
+# Migrations, applied in order to bring sections from version N to N + 1.
+# Each takes and returns an iterable of (section, kind, entries).
+def migrate_v0(sections):
+    # Version 1 only adds schema_version, which upgrade() writes
+    return sections
+
+MIGRATIONS = {0: migrate_v0}
+
+def upgrade(path):
+    """Yield the file's sections at SCHEMA_VERSION, starting with schema_version"""
+    version = schema_version(path)
+    if version > SCHEMA_VERSION:
+        raise ValueError(f'{path} has schema version {version}; this tool supports up to {SCHEMA_VERSION}')
+
+    sections = (section for section in read_sections(path) if section[0] != 'schema_version')
+    for from_version in range(version, SCHEMA_VERSION):
+        sections = MIGRATIONS[from_version](sections)
+
+    yield 'schema_version', 'scalar', iter([(None, SCHEMA_VERSION)])
+    yield from with_ticket_counter(sections)
+
+def with_ticket_counter(sections):
+    """Pass sections through, ending with a ticket_counter that covers every ticket id read.
+
+    Compaction may then drop the highest-numbered tickets without the bot
+    issuing their ids again.
+    """
+    last_id = 0
+
+    def observe(entries):
+        nonlocal last_id
+        for ticket_id, ticket in entries:
+            if ticket_id.isdigit():
+                last_id = max(last_id, int(ticket_id))
+            yield ticket_id, ticket
+
+    for section, kind, entries in sections:
+        if section == 'ticket_counter':
+            for _, value in entries:
+                if is_type(value, int):
+                    last_id = max(last_id, value)
+        elif section == 'tickets':
+            yield section, kind, observe(entries)
+        else:
+            yield section, kind, entries
+
+    if last_id:
+        yield 'ticket_counter', 'scalar', iter([(None, last_id)])
+
+# Compaction
+def item_names(path):
+    """Return {(guild id, item name)} for every item still in a vending machine"""
+    names = set()
+    for section, _, entries in read_sections(path):
+        if section == 'vending_machines':
+            for guild_id, machine in entries:
+                names.update((guild_id, item['name']) for item in machine.get('items', {}).values())
+            # No other section is needed
+            break
+    return names
+
+def transcript_files(data_path, ticket_id, ticket):
+    """Return the existing transcript files of a ticket.
+
+    Relative paths are resolved against the data file's directory, which is the
+    bot's working directory.
+    """
+    base = os.path.dirname(os.path.abspath(data_path))
+    candidates = {os.path.join(os.getenv('TRANSCRIPT_DIR', 'transcripts'), f'ticket-{ticket_id}.jsonl.gz')}
+    if isinstance(ticket.get('transcript'), dict) and ticket['transcript'].get('path'):
+        candidates.add(ticket['transcript']['path'])
+    paths = {os.path.normpath(os.path.join(base, candidate)) for candidate in candidates}
+    return sorted(path for path in paths if os.path.exists(path))
+
+def is_empty_user(user):
+    # Created by /addcoins for someone who never authenticated, with nothing left;
+    # guilds only records where the coins were granted
+    return set(user) <= {'coins', 'authenticated', 'guilds'} and not user.get('coins') and not user.get('authenticated')
+
+class Compactor:
+    """Filters sections, counting what each rule removed"""
+
+    def __init__(self, data_path, live_items=None, closed_ticket_days=None, dedup_window=DEDUP_WINDOW):
+        self.data_path = data_path
+        self.live_items = live_items
+        self.ticket_cutoff = datetime.now() - timedelta(days=closed_ticket_days) if closed_ticket_days is not None else None
+        self.dedup_window = dedup_window
+        self.removed = Counter()
+        # Transcripts of removed tickets, deleted once the output is written
+        self.transcripts = []
+
+    def is_old_closed_ticket(self, ticket):
+        if self.ticket_cutoff is None or ticket.get('status') != 'closed' or not ticket.get('closed_at'):
+            return False
+        return datetime.fromisoformat(ticket['closed_at']) < self.ticket_cutoff
+
+    def transactions(self, entries):
+        # Exact duplicates (e.g. a retried write) land close together, so only
+        # a window of recent transactions is remembered
+        recent = deque()
+        seen = set()
+        for key, transaction in entries:
+            if self.live_items is not None and (transaction.get('guild_id'), transaction.get('item_name')) not in self.live_items:
+                self.removed['orphan transactions'] += 1
+                continue
+            fingerprint = json.dumps(transaction, sort_keys=True, ensure_ascii=False)
+            if fingerprint in seen:
+                self.removed['duplicate transactions'] += 1
+                continue
+            seen.add(fingerprint)
+            recent.append(fingerprint)
+            if len(recent) > self.dedup_window:
+                seen.discard(recent.popleft())
+            yield key, transaction
+
+    def filter(self, section, entries):
+        for key, value in entries:
+            if section == 'users' and is_empty_user(value):
+                self.removed['empty users'] += 1
+            elif section == 'vending_machines' and not value.get('items'):
+                self.removed['empty vending machines'] += 1
+            elif section == 'tickets' and self.is_old_closed_ticket(value):
+                self.removed['closed tickets'] += 1
+                self.transcripts.extend(transcript_files(self.data_path, key, value))
+            else:
+                yield key, value
+
+    def compact(self, sections):
+        for section, kind, entries in sections:
+            if section == 'transactions':
+                yield section, kind, self.transactions(entries)
+            else:
+                yield section, kind, self.filter(section, entries)
+
+# Commands
+def format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            return f'{size:.1f} {unit}' if unit != 'B' else f'{size} B'
+        size /= 1024
+
+def peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def report_footer(start):
+    line = f'took {time.monotonic() - start:.1f}s'
+    peak = peak_memory()
+    if peak is not None:
+        line += f', peak memory {format_bytes(peak)}'
+    print(line)
+
+def cmd_stats(args):
+    start = time.monotonic()
+    live_items = item_names(args.path)
+    print(f'{args.path}: {format_bytes(os.path.getsize(args.path))}, {data_format(args.path)}, '
+          f'schema version {schema_version(args.path)}')
+
+    extra = Counter()
+    print(f'{"section":<18}{"rows":>12}{"json bytes":>14}')
+    for section, kind, entries in read_sections(args.path):
+        rows = size = 0
+        for _, value in entries:
+            rows += 1
+            size += len(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+            if section == 'users' and is_empty_user(value):
+                extra['empty users'] += 1
+            elif section == 'tickets':
+                extra[f'{value.get("status")} tickets'] += 1
+            elif section == 'vending_machines':
+                extra['items'] += len(value.get('items', {}))
+            elif section == 'transactions' and (value.get('guild_id'), value.get('item_name')) not in live_items:
+                extra['orphan transactions'] += 1
+        print(f'{section:<18}{rows if kind != "scalar" else "-":>12}{format_bytes(size):>14}')
+
+    for name, count in sorted(extra.items()):
+        print(f'  {name}: {count}')
+    report_footer(start)
+    return 0
+
+def cmd_validate(args):
+    start = time.monotonic()
+    errors = 0
+
+    def report(message):
+        nonlocal errors
+        errors += 1
+        if errors <= MAX_REPORTED_ERRORS:
+            print(message)
+
+    version = None
+    seen = set()
+    rows = 0
+    try:
+        for section, kind, entries in read_sections(args.path):
+            seen.add(section)
+            if section not in SECTION_KINDS:
+                report(f'{section}: unknown section')
+            elif kind != SECTION_KINDS[section]:
+                report(f'{section}: expected {SECTION_KINDS[section]}, found {kind}')
+                continue
+            for key, value in entries:
+                rows += 1
+                for error in entry_errors(section, key, value):
+                    report(error)
+                if section == 'schema_version':
+                    version = value
+    except (ValueError, UnicodeDecodeError) as e:
+        report(f'unreadable: {e}')
+
+    for section in sorted(REQUIRED_SECTIONS - seen):
+        report(f'{section}: missing section')
+    if version is None:
+        print(f'no schema_version; run "migrate" to upgrade to version {SCHEMA_VERSION}')
+    elif is_type(version, int) and version > SCHEMA_VERSION:
+        report(f'schema_version {version} is newer than this tool ({SCHEMA_VERSION})')
+
+    if errors > MAX_REPORTED_ERRORS:
+        print(f'... {errors - MAX_REPORTED_ERRORS} more')
+    print(f'{rows} rows checked, {errors} error(s)')
+    report_footer(start)
+    return 1 if errors else 0
+
+def cmd_compact(args):
+    start = time.monotonic()
+    output = args.output or args.path
+    compactor = Compactor(
+        args.path,
+        live_items=item_names(args.path) if args.drop_orphan_transactions else None,
+        closed_ticket_days=args.closed_ticket_days,
+        dedup_window=args.dedup_window
+    )
+
+    size = os.path.getsize(args.path)
+    counts = write_sections(output, compactor.compact(upgrade(args.path)))
+    print(f'wrote {output}: {format_bytes(size)} -> {format_bytes(os.path.getsize(output))}')
+    for section, count in counts.items():
+        if section != 'schema_version':
+            print(f'  {section}: {count} kept')
+    for name, count in sorted(compactor.removed.items()):
+        print(f'  {name}: {count} removed')
+
+    # Only delete transcripts once the removal has replaced the live file
+    if compactor.transcripts and output == args.path:
+        for transcript in compactor.transcripts:
+            os.remove(transcript)
+        print(f'  transcripts: {len(compactor.transcripts)} deleted')
+    elif compactor.transcripts:
+        print('  transcripts of removed tickets (kept, since -o was given):')
+        for transcript in compactor.transcripts:
+            print(f'    {transcript}')
+    report_footer(start)
+    return 0
+
+def cmd_migrate(args):
+    start = time.monotonic()
+    output = args.output or os.path.splitext(args.path)[0] + '.' + args.to
+    if data_format(output) != args.to:
+        print(f'output file {output} does not end in .{args.to}', file=sys.stderr)
+        return 2
+
+    counts = write_sections(output, upgrade(args.path))
+    print(f'wrote {output} ({args.to}, schema version {SCHEMA_VERSION}, {format_bytes(os.path.getsize(output))})')
+    for section, count in counts.items():
+        if section != 'schema_version':
+            print(f'  {section}: {count}')
+    report_footer(start)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline maintenance for the bot data file. Stop the bot first.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_command(name, handler, help_text):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('path', nargs='?', default=DATA_FILE, help=f'data file (.json or .jsonl, default {DATA_FILE})')
+        command.set_defaults(handler=handler)
+        return command
+
+    add_command('stats', cmd_stats, 'print size and row statistics')
+    add_command('validate', cmd_validate, 'check the file against the schema')
+
+    compact = add_command('compact', cmd_compact, 'remove dead records (rewrites the file unless -o is given)')
+    compact.add_argument('-o', '--output', help='write here instead of replacing the input')
+    compact.add_argument('--drop-orphan-transactions', action='store_true',
+                         help='remove transactions for items that no longer exist')
+    compact.add_argument('--closed-ticket-days', type=int, metavar='N',
+                         help='remove tickets closed more than N days ago')
+    compact.add_argument('--dedup-window', type=int, default=DEDUP_WINDOW, metavar='N',
+                         help=f'transactions remembered when looking for duplicates (default {DEDUP_WINDOW})')
+
+    migrate = add_command('migrate', cmd_migrate, 'convert between json and jsonl and upgrade the schema')
+    migrate.add_argument('--to', choices=('json', 'jsonl'), required=True)
+    migrate.add_argument('-o', '--output', help='output file (default: input name with the new extension)')
+
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.path):
+        print(f'{args.path} does not exist', file=sys.stderr)
+        return 2
+    return args.handler(args)
+
+if __name__ == '__main__':
+    sys.exit(main())